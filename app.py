@@ -1,3 +1,12 @@
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
 import numpy as np
 import pandas as pd
 
@@ -6,85 +15,125 @@ import dash_core_components as dcc
 import dash_html_components as html
 import dash_bootstrap_components as dbc
 from dash.dependencies import Input, Output, State
+from dash.exceptions import PreventUpdate
 
 import plotly.express as px
 import plotly.figure_factory as ff
 import plotly.graph_objects as go
+from flask import jsonify
+
+import recode_spec
+
+### Load Data
+
+# Load a numeric CSV through a cache of column arrays stored as .npy files under data/cache. The
+# arrays are memory-mapped read-only, so all gunicorn workers share a single copy in the page cache
+def load_shared_csv(csv_path):
+    cache_dir = os.path.join(os.path.dirname(csv_path), 'cache', os.path.splitext(os.path.basename(csv_path))[0])
+    manifest_path = os.path.join(cache_dir, 'columns.json')
+    
+    if not os.path.exists(manifest_path) or os.path.getmtime(manifest_path) < os.path.getmtime(csv_path):
+        df = pd.read_csv(csv_path)
+        os.makedirs(cache_dir, exist_ok=True)
+        manifest = {
+            'int': [col for col in df.columns if df[col].dtype.kind in 'iub'],
+            'float': [col for col in df.columns if df[col].dtype.kind not in 'iub']
+        }
+        # Arrays are stored one row per column, so each column is contiguous in memory
+        for kind, dtype in (('int', np.int64), ('float', np.float64)):
+            temp_path = os.path.join(cache_dir, '{}.{}.tmp.npy'.format(kind, uuid.uuid4().hex))
+            np.save(temp_path, np.ascontiguousarray(df[manifest[kind]].values.T, dtype=dtype))
+            os.replace(temp_path, os.path.join(cache_dir, kind + '.npy'))
+        temp_path = '{}.{}.tmp'.format(manifest_path, uuid.uuid4().hex)
+        with open(temp_path, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(temp_path, manifest_path)
+    
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    frames = []
+    for kind in ('int', 'float'):
+        if manifest[kind]:
+            values = np.load(os.path.join(cache_dir, kind + '.npy'), mmap_mode='r')
+            frames.append(pd.DataFrame(values.T, columns=manifest[kind], copy=False))
+            
+    return pd.concat(frames, axis=1, copy=False)
+
+# Read memory use of the current process in MB. PSS splits shared pages between the processes using them
+def read_process_memory():
+    memory = {'pid': os.getpid()}
+    for path, fields in (('/proc/self/status', ('VmRSS',)), ('/proc/self/smaps_rollup', ('Pss', 'Shared_Clean', 'Shared_Dirty', 'Private_Clean', 'Private_Dirty'))):
+        try:
+            with open(path) as f:
+                for line in f:
+                    name, _, value = line.partition(':')
+                    if name in fields:
+                        memory[name] = int(value.split()[0]) / 1024
+        except OSError:
+            pass
+    
+    return memory
 
-crash_df = pd.read_csv('data/clean-crash-data.csv')
+# Crash counts per municipality, year and month for the county overview
+summary_df = pd.read_csv('data/municipality-summary.csv')
 
 ### Define Constant Values
 
-CENTER_LAT = (max(crash_df['DEC_LAT']) - min(crash_df['DEC_LAT'])) / 2 + min(crash_df['DEC_LAT'])
-CENTER_LON = (max(crash_df['DEC_LONG']) - min(crash_df['DEC_LONG'])) / 2 + min(crash_df['DEC_LONG'])  
+# Crash data is partitioned by municipality under data/municipalities/<code>
+MUNICIPALITY_DIR = os.path.join('data', 'municipalities')
+DEFAULT_MUNICIPALITY = 2301
+MUNICIPALITY_CACHE_SIZE = 8
+COUNTY_OVERVIEW_COUNT = 25
 
 MAP_PANEL_HEIGHT = 700
 
-DISCRETE_COLORS = px.colors.qualitative.G10
+# Background map render jobs - job state is kept in files so that any gunicorn worker can answer a poll
+MAP_JOB_DIR = os.path.join(tempfile.gettempdir(), 'pitt-crash-map-jobs')
+MAP_JOB_THREADS = 2
+MAP_JOB_POLL_MS = 500
+MAP_JOB_MAX_AGE = 3600
 
-# Categorical varible label dictionaries
-illum_dict = {
-    1: 'Daylight',
-    2: 'Dark - No Street Lights',
-    3: 'Dark - Street Lights',
-    4: 'Dusk',
-    5: 'Dawn',
-    6: 'Dark - Unknown Roadway Lighting',
-    8: 'Other or Unknown'
-}
+YEAR_MIN = 2010
+YEAR_MAX = 2019
+N_CLUSTERS = 6
 
-collision_dict = {
-    0: 'Non-Collision',
-    1: 'Rear-End',
-    2: 'Head-On',
-    3: 'Rear-to-Rear (Backing)',
-    4: 'Angle',
-    5: 'Sideswipe (Same Direction)',
-    6: 'Sideswipe (Opposite Direction)',
-    7: 'Hit Fixed Object',
-    8: 'Hit Pedestrian',
-    9: 'Other or Unknown'
-}
+DISCRETE_COLORS = px.colors.qualitative.G10
 
-condition_dict = {
-    0: 'Dry',
-    1: 'Wet',
-    2: 'Sand / Mud / Dirt / Oil / Gravel',
-    3: 'Snow-Covered',
-    4: 'Slush',
-    5: 'Ice',
-    6: 'Ice Patches',
-    7: 'Water (Standing or Moving)',
-    9: 'Other or Unknown'
+# Municipality names, other municipalities are labelled by their county code
+municipality_dict = {
+    2301: 'City of Pittsburgh'
 }
 
-relation_dict = {
-    1: 'On Roadway',
-    2: 'Shoulder',
-    3: 'Median',
-    4: 'Roadside ',
-    5: 'Outside Trafficway ',
-    6: 'In Parking Lane',
-    7: 'Intersection of Ramp and Highway',
-    9: 'Other or Unknown'
-}
+# Categorical varible label dictionaries, generated from the recode specification used by data-preprocessing.py
+illum_dict = recode_spec.label_dict('ILLUMINATION')
+collision_dict = recode_spec.label_dict('COLLISION_TYPE')
+condition_dict = recode_spec.label_dict('ROAD_CONDITION')
+relation_dict = recode_spec.label_dict('RELATION_TO_ROAD')
+injury_dict = recode_spec.label_dict('MAX_INJURY_SEVERITY')
+day_dict = recode_spec.label_dict('DAY_OF_WEEK')
+hour_dict = recode_spec.label_dict('HOUR_OF_DAY')
 
-injury_dict = {
-    0: 'No Injuries Reported',
-    1: 'Minor Injury',
-    2: 'Moderate Injury',
-    3: 'Major Injury',
-    4: 'Fatal ',
+cluster_dict = {
+    0: '0 - Local Road Daytime Impairment / Inclement Weather',
+    1: '1 - Local Road Aggressive Driving / Lack of Clearance ',
+    2: '2 - Large Road Nighttime Impairment / Inclement Weather',
+    3: '3 - Large Road Rear-End / Tailgating / Speeding - Injury-Causing',
+    4: '4 - Pedestrian / Motorcycle / Bicycle - Injury-Causing',
+    5: '5 - Local Road Intersection / Running a Red Light / Wet Roads',
 }
 
-day_dict = {
-    1: 'Sunday',
-    2: 'Monday',
-    3: 'Tuesday',
-    4: 'Wednesday',
-    5: 'Thursday',
-    6: 'Friday',
-    7: 'Saturday'
+# Binary flag label dictionary
+flag_dict = recode_spec.FLAG_LABELS
+
+# Categorical features shown in the cluster profile, with their value labels
+profile_feature_dict = {
+    'ILLUMINATION': ('Illumination', illum_dict),
+    'ROAD_CONDITION': ('Road Condition', condition_dict),
+    'COLLISION_TYPE': ('Collision Type', collision_dict),
+    'RELATION_TO_ROAD': ('Relation to Road', relation_dict),
+    'MAX_INJURY_SEVERITY': ('Max Injury Severity', injury_dict),
+    'DAY_OF_WEEK': ('Day of Week', day_dict),
+    'HOUR_OF_DAY': ('Hour of Day', hour_dict),
 }
 
 # Categorical variable color maps for bar plots
@@ -93,6 +142,7 @@ condition_color_map = dict(zip(condition_dict.values(), DISCRETE_COLORS[:len(con
 relation_color_map = dict(zip(relation_dict.values(), DISCRETE_COLORS[:len(relation_dict)]))
 collision_color_map = dict(zip(collision_dict.values(), DISCRETE_COLORS[:len(collision_dict)]))
 injury_color_map = dict(zip(injury_dict.values(), DISCRETE_COLORS[:len(injury_dict)]))
+cluster_color_map = {'Cluster {}'.format(i): DISCRETE_COLORS[i] for i in range(N_CLUSTERS)}
 
 # Create blank figure to display when there is not enough data
 FIG_NONE = go.Figure()
@@ -125,21 +175,26 @@ FIG_NONE.update_layout(
 
 ### Define Helper Functions
 
-# Retrieve data with filters from user controls
-def get_data(cluster_number, collision_type, road_condition, illumination, relation, injury, year_range, month_range, highlight):
+# Build a boolean mask over a municipality's crash rows with filters from user controls
+def get_mask(data, cluster_number, collision_type, road_condition, illumination, relation, injury, year_range, month_range, highlight):
+    crash_df = data['crash_df']
+    mask = (crash_df['CRASH_YEAR'] >= year_range[0]) & (crash_df['CRASH_YEAR'] <= year_range[1])
+    mask &= (crash_df['CRASH_MONTH'] >= month_range[0]) & (crash_df['CRASH_MONTH'] <= month_range[1])
+    mask &= crash_df['KMODE_CLUSTER'].isin(cluster_number)
+    mask &= crash_df['COLLISION_TYPE'].isin(collision_type)
+    mask &= crash_df['ROAD_CONDITION'].isin(road_condition)
+    mask &= crash_df['ILLUMINATION'].isin(illumination)
+    mask &= crash_df['RELATION_TO_ROAD'].isin(relation)
+    mask &= crash_df['MAX_INJURY_SEVERITY'].isin(injury)
     if highlight:
-        df = crash_df.loc[crash_df[highlight] == 1].reset_index(drop=True) 
+        mask &= crash_df[highlight] == 1
         
-    else:
-        df = crash_df
-    df = df.loc[(df['CRASH_YEAR'] >= year_range[0]) & (df['CRASH_YEAR'] <= year_range[1])].reset_index(drop=True)
-    df = df.loc[(df['CRASH_MONTH'] >= month_range[0]) & (df['CRASH_MONTH'] <= month_range[1])].reset_index(drop=True)
-    df = df.loc[df['KMODE_CLUSTER'].isin(cluster_number)].reset_index(drop=True)
-    df = df.loc[df['COLLISION_TYPE'].isin(collision_type)].reset_index(drop=True)
-    df = df.loc[df['ROAD_CONDITION'].isin(road_condition)].reset_index(drop=True)
-    df = df.loc[df['ILLUMINATION'].isin(illumination)].reset_index(drop=True)
-    df = df.loc[df['RELATION_TO_ROAD'].isin(relation)].reset_index(drop=True)
-    df = df.loc[df['MAX_INJURY_SEVERITY'].isin(injury)].reset_index(drop=True)
+    return mask.values
+
+# Retrieve data with filters from user controls
+def get_data(data, cluster_number, collision_type, road_condition, illumination, relation, injury, year_range, month_range, highlight):
+    df = data['crash_df'].loc[get_mask(data, cluster_number, collision_type, road_condition, illumination, relation, 
+                                       injury, year_range, month_range, highlight)].reset_index(drop=True)
     
     if len(df) == 0:
         df.loc[0] = 0
@@ -158,6 +213,234 @@ def make_bar_chart(df, var_name, y_title, x_label_dict, color_map):
                   color_discrete_map=color_map,
                   labels={var_name: y_title, 'CRASH_CRN': '# of Accidents'}).update_layout(showlegend=False)
 
+# Count filtered crashes at each unique location, split by a categorical column if one is given
+def aggregate_locations(data, mask, color_value=None):
+    if not mask.any():
+        df = pd.DataFrame({'LOCATION_ID': [0], 'DEC_LAT': [0.0], 'DEC_LONG': [0.0], 'COUNT': [0]})
+        if color_value:
+            df[color_value] = 0
+        return df
+    
+    if color_value is None:
+        df = data['location_df'].copy()
+        df['COUNT'] = sum_members(mask.astype(int), data['location_order'], data['location_offsets'])
+        return df.loc[df['COUNT'] > 0].reset_index(drop=True)
+    
+    location_dfs = []
+    column = data['crash_df'][color_value].values
+    for value in np.unique(column[mask]):
+        df = data['location_df'].copy()
+        df[color_value] = value
+        df['COUNT'] = sum_members((mask & (column == value)).astype(int), data['location_order'], data['location_offsets'])
+        location_dfs.append(df.loc[df['COUNT'] > 0])
+        
+    return pd.concat(location_dfs, ignore_index=True)
+
+# Create geo map figure for the selected map type, with one point per location weighted by its crash count
+def make_geo_map(data, mask, map_type, active_tab, current_zoom, current_center_lat, current_center_lon):
+    if map_type == 2:
+        if active_tab == 'bar-illumination':
+            color_value = 'ILLUMINATION'
+            label_dict = illum_dict
+            color_map = illum_color_map
+        elif active_tab == 'bar-condition': 
+            color_value = 'ROAD_CONDITION'
+            label_dict = condition_dict
+            color_map = condition_color_map
+        elif active_tab == 'bar-relation':
+            color_value = 'RELATION_TO_ROAD'
+            label_dict = relation_dict
+            color_map = relation_color_map
+        elif active_tab == 'bar-injury':
+            color_value = 'MAX_INJURY_SEVERITY'
+            label_dict = injury_dict
+            color_map = injury_color_map
+        else:
+            color_value = 'COLLISION_TYPE'
+            label_dict = collision_dict
+            color_map = collision_color_map
+        df = aggregate_locations(data, mask, color_value).replace({color_value:label_dict})
+            
+        fig = px.scatter_mapbox(df, lat='DEC_LAT', lon='DEC_LONG', 
+                                color=color_value, mapbox_style='stamen-terrain',
+                                color_discrete_map=color_map,
+                                size='COUNT', size_max=20,
+                                hover_data={'COUNT': True, 'DEC_LAT': False, 'DEC_LONG': False},
+                                labels={'COUNT': '# of Accidents'},
+                                zoom=current_zoom, 
+                                center=dict(lat=current_center_lat, lon=current_center_lon))
+        fig.update_traces(marker_sizemin=3)
+        fig.layout.height = MAP_PANEL_HEIGHT
+        fig.update_layout(margin=dict(l=20, r=20, t=20, b=20))
+    
+    elif map_type == 1:
+        df = aggregate_locations(data, mask)
+        fig = px.density_mapbox(
+            df, lat='DEC_LAT', lon='DEC_LONG', z='COUNT', radius=5,
+            labels={'COUNT': '# of Accidents'},
+            center=dict(lat=current_center_lat, lon=current_center_lon), 
+            zoom=current_zoom, mapbox_style='stamen-terrain')
+        fig.layout.height = MAP_PANEL_HEIGHT
+        fig.update_layout(
+            margin=dict(l=20, r=20, t=20, b=20)
+        )
+        
+    elif map_type == 0:
+        df = aggregate_locations(data, mask)
+        fig = ff.create_hexbin_mapbox(
+            data_frame=df, lat="DEC_LAT", lon="DEC_LONG", color='COUNT', agg_func=np.sum,
+            nx_hexagon=300, opacity=0.5, labels={"color": "# of Accidents"},
+            min_count=1, mapbox_style='stamen-terrain', show_original_data=True,
+            original_data_marker=dict(size=np.minimum(3 + np.sqrt(np.maximum(df['COUNT'].values - 1, 0)), 12), opacity=0.6, color='black'),
+            zoom=current_zoom, center=dict(lat=current_center_lat, lon=current_center_lon)
+        )
+        fig.update_traces(
+            selector=dict(type='scattermapbox'),
+            customdata=df['COUNT'].values,
+            hovertemplate='# of Accidents: %{customdata}<extra></extra>',
+            # create_hexbin_mapbox skips hover on the original data points, which would hide the template
+            hoverinfo=None
+        )
+        fig.layout.height = MAP_PANEL_HEIGHT
+        fig.update_layout(
+            margin=dict(l=20, r=20, t=20, b=20),
+        )
+        
+    return fig
+
+# Read the map view from a mapbox relayoutData event, or None if the event did not move the map
+def read_map_view(relayout_data):
+    try:
+        return {
+            'zoom': relayout_data['mapbox.zoom'],
+            'lat': relayout_data['mapbox.center']['lat'],
+            'lon': relayout_data['mapbox.center']['lon']
+        }
+    except (KeyError, TypeError):
+        return None
+
+# Path of a background map job file ('status' or 'figure'), or of the latest job marker for a session
+def map_job_path(key, kind):
+    return os.path.join(MAP_JOB_DIR, '{}.{}.json'.format(key, kind))
+
+# Write a JSON file atomically, so a poll from another worker never reads a partial file
+def write_json_atomic(path, data):
+    temp_path = '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+    with open(temp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(temp_path, path)
+
+# The status records the pid of the worker that owns the job, so polls from any worker can tell
+# whether a queued or running job can still finish
+def set_map_job_status(job_id, state, progress):
+    write_json_atomic(map_job_path(job_id, 'status'), {'state': state, 'progress': progress, 'pid': os.getpid()})
+
+def is_process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    
+    return True
+
+# Queued or running jobs are reported as failed once their worker has died or been recycled
+def read_map_job_status(job_id):
+    try:
+        with open(map_job_path(job_id, 'status')) as f:
+            status = json.load(f)
+    except (OSError, ValueError):
+        return {'state': 'failed', 'progress': 0}
+    
+    if status['state'] in ('queued', 'running') and not is_process_alive(status['pid']):
+        return {'state': 'failed', 'progress': 0}
+    
+    return status
+
+# Drop a delivered figure but keep the status, so a poll racing the delivery sees it was already delivered
+def mark_map_job_delivered(job_id):
+    set_map_job_status(job_id, 'delivered', 100)
+    try:
+        os.remove(map_job_path(job_id, 'figure'))
+    except OSError:
+        pass
+
+# A job is superseded once a newer map request from the same session has been submitted
+def is_map_job_superseded(job_id, session_id):
+    try:
+        with open(map_job_path(session_id, 'latest')) as f:
+            return json.load(f) != job_id
+    except (OSError, ValueError):
+        return False
+
+# Remove job files left behind by renders that were never polled
+def clean_map_jobs():
+    cutoff = time.time() - MAP_JOB_MAX_AGE
+    for file_name in os.listdir(MAP_JOB_DIR):
+        path = os.path.join(MAP_JOB_DIR, file_name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
+
+# Render the geo map in a background thread, checking between stages whether it was superseded
+def run_map_job(job_id, session_id, municipality, filters, map_type, active_tab, current_zoom, current_center_lat, current_center_lon):
+    try:
+        if is_map_job_superseded(job_id, session_id):
+            set_map_job_status(job_id, 'cancelled', 0)
+            return
+        set_map_job_status(job_id, 'running', 10)
+        data = load_municipality(municipality)
+        mask = get_mask(data, *filters)
+        
+        if is_map_job_superseded(job_id, session_id):
+            set_map_job_status(job_id, 'cancelled', 0)
+            return
+        set_map_job_status(job_id, 'running', 40)
+        fig = make_geo_map(data, mask, map_type, active_tab, current_zoom, current_center_lat, current_center_lon)
+        
+        if is_map_job_superseded(job_id, session_id):
+            set_map_job_status(job_id, 'cancelled', 0)
+            return
+        set_map_job_status(job_id, 'running', 80)
+        temp_path = '{}.{}.tmp'.format(map_job_path(job_id, 'figure'), uuid.uuid4().hex)
+        fig.write_json(temp_path)
+        os.replace(temp_path, map_job_path(job_id, 'figure'))
+        set_map_job_status(job_id, 'done', 100)
+    except Exception:
+        # Nothing reads the job's future, so log the error here rather than re-raising it
+        server.logger.exception('Map job %s failed', job_id)
+        set_map_job_status(job_id, 'failed', 0)
+
+# Queue a background map render, superseding the previous render from the same session
+def submit_map_job(session_id, municipality, filters, map_type, active_tab, current_zoom, current_center_lat, current_center_lon):
+    clean_map_jobs()
+    job_id = uuid.uuid4().hex
+    set_map_job_status(job_id, 'queued', 0)
+    write_json_atomic(map_job_path(session_id, 'latest'), job_id)
+    
+    # Jobs still queued in this worker are dropped right away, running ones stop at their next check
+    with MAP_JOB_FUTURES_LOCK:
+        previous_job = MAP_JOB_FUTURES.pop(session_id, None)
+        if previous_job is not None and previous_job[1].cancel():
+            set_map_job_status(previous_job[0], 'cancelled', 0)
+        future = MAP_JOB_EXECUTOR.submit(
+            run_map_job, job_id, session_id, municipality, filters, map_type, active_tab, 
+            current_zoom, current_center_lat, current_center_lon
+        )
+        MAP_JOB_FUTURES[session_id] = job_id, future
+    future.add_done_callback(lambda future: forget_map_job(session_id, job_id))
+    
+    return job_id
+
+# Drop a finished job's future, unless the session has already submitted a newer one
+def forget_map_job(session_id, job_id):
+    with MAP_JOB_FUTURES_LOCK:
+        if MAP_JOB_FUTURES.get(session_id, (None, None))[0] == job_id:
+            del MAP_JOB_FUTURES[session_id]
+
 # Create heatmap
 def generate_heatmap(df):
     day_hour_group = df[df['HOUR_OF_DAY'] != 99.0].groupby(['DAY_OF_WEEK', 'HOUR_OF_DAY'],sort=False).agg(['count'])
@@ -166,6 +449,134 @@ def generate_heatmap(df):
         
     return day_hour_heatmap
 
+# Count crashes into a (year, month, cluster, injury severity) array
+def build_trend_counts(df):
+    shape = (YEAR_MAX - YEAR_MIN + 1, 12, N_CLUSTERS, len(injury_dict))
+    df = df.loc[(df['CRASH_YEAR'] >= YEAR_MIN) & (df['CRASH_YEAR'] <= YEAR_MAX)]
+    flat_index = np.ravel_multi_index(
+        (
+            df['CRASH_YEAR'].values.astype(int) - YEAR_MIN,
+            df['CRASH_MONTH'].values.astype(int) - 1,
+            df['KMODE_CLUSTER'].values.astype(int),
+            df['MAX_INJURY_SEVERITY'].values.astype(int)
+        ),
+        shape
+    )
+    
+    return np.bincount(flat_index, minlength=np.prod(shape)).reshape(shape)
+
+# Compile cluster profile counts into per-feature (year, month, cluster, value) arrays
+def build_profile_counts(profile_df):
+    profile_counts = {}
+    profile_df = profile_df.loc[(profile_df['CRASH_YEAR'] >= YEAR_MIN) & (profile_df['CRASH_YEAR'] <= YEAR_MAX)]
+    for feature, feature_df in profile_df.groupby('FEATURE'):
+        values = np.sort(feature_df['VALUE'].unique())
+        counts = np.zeros((YEAR_MAX - YEAR_MIN + 1, 12, N_CLUSTERS, len(values)), dtype=int)
+        np.add.at(
+            counts, 
+            (
+                feature_df['CRASH_YEAR'].values.astype(int) - YEAR_MIN,
+                feature_df['CRASH_MONTH'].values.astype(int) - 1,
+                feature_df['KMODE_CLUSTER'].values.astype(int),
+                np.searchsorted(values, feature_df['VALUE'].values)
+            ),
+            feature_df['COUNT'].values
+        )
+        profile_counts[feature] = (values, counts)
+        
+    return profile_counts
+
+# Group row positions by an integer key (0 to n_keys - 1) into a member order and per-key offsets,
+# so the rows with key k are order[offsets[k]:offsets[k + 1]]
+def build_member_index(keys, n_keys):
+    order = np.argsort(keys, kind='stable')
+    offsets = np.searchsorted(keys[order], np.arange(n_keys + 1))
+    
+    return order, offsets
+
+# Sum values over the members of every key
+def sum_members(values, order, offsets):
+    cumulative = np.concatenate([[0], np.cumsum(values[order])])
+    
+    return cumulative[offsets[1:]] - cumulative[offsets[:-1]]
+
+# Check whether a dropdown selection includes every category
+def is_unfiltered(selected, label_dict):
+    return set(selected) >= set(label_dict)
+
+# Read a municipality's partition with its precomputed aggregates and member indexes
+def read_municipality(municipality):
+    partition_dir = os.path.join(MUNICIPALITY_DIR, str(municipality))
+    crash_df = load_shared_csv(os.path.join(partition_dir, 'clean-crash-data.csv'))
+    hotspot_df = pd.read_csv(os.path.join(partition_dir, 'hotspots.csv'))
+    location_df = pd.read_csv(os.path.join(partition_dir, 'locations.csv'))
+    
+    hotspot_order, hotspot_offsets = build_member_index(crash_df['HOTSPOT_ID'].values, len(hotspot_df))
+    location_order, location_offsets = build_member_index(crash_df['LOCATION_ID'].values, len(location_df))
+    
+    return {
+        'crash_df': crash_df,
+        'hotspot_df': hotspot_df,
+        'location_df': location_df,
+        # Trend counts, sliced by the trend callback
+        'trend_counts': build_trend_counts(crash_df),
+        # Cluster x feature x value counts, sliced by the cluster profile callback
+        'profile_counts': build_profile_counts(pd.read_csv(os.path.join(partition_dir, 'cluster-profile.csv'))),
+        # Crash rows in each hotspot and their severity weights, used to rescore hotspots under filters
+        'hotspot_order': hotspot_order,
+        'hotspot_offsets': hotspot_offsets,
+        'crash_severity_weights': recode_spec.SEVERITY_WEIGHTS[crash_df['MAX_INJURY_SEVERITY'].values],
+        # Crash rows at each unique location, used to send one map point per location
+        'location_order': location_order,
+        'location_offsets': location_offsets
+    }
+
+# Label a municipality by name, or by its county code
+def municipality_label(municipality):
+    return municipality_dict.get(municipality, 'Municipality {}'.format(municipality))
+
+# Read the default municipality at import, so that with preload_app it is shared by all gunicorn workers.
+# It is kept outside the partition cache, so visiting other municipalities never evicts it
+DEFAULT_PARTITION = read_municipality(DEFAULT_MUNICIPALITY)
+
+# Other partitions are read on first use and the least recently used ones are dropped once the cache is full
+@lru_cache(maxsize=MUNICIPALITY_CACHE_SIZE)
+def read_cached_municipality(municipality):
+    return read_municipality(municipality)
+
+# One lock per municipality, so concurrent first requests wait for a single read of the partition
+MUNICIPALITY_LOCKS = {}
+MUNICIPALITY_LOCKS_GUARD = threading.Lock()
+
+def load_municipality(municipality):
+    if municipality == DEFAULT_MUNICIPALITY:
+        return DEFAULT_PARTITION
+    
+    with MUNICIPALITY_LOCKS_GUARD:
+        lock = MUNICIPALITY_LOCKS.setdefault(municipality, threading.Lock())
+    with lock:
+        return read_cached_municipality(municipality)
+
+# Centre of a municipality's crash locations, read from its small locations file so the map view
+# can be reset without loading the whole partition
+@lru_cache(maxsize=None)
+def municipality_center(municipality):
+    location_df = pd.read_csv(os.path.join(MUNICIPALITY_DIR, str(municipality), 'locations.csv'), usecols=['DEC_LAT', 'DEC_LONG'])
+    
+    return (
+        float((location_df['DEC_LAT'].max() - location_df['DEC_LAT'].min()) / 2 + location_df['DEC_LAT'].min()),
+        float((location_df['DEC_LONG'].max() - location_df['DEC_LONG'].min()) / 2 + location_df['DEC_LONG'].min())
+    )
+
+# Municipalities ordered by total number of crashes
+municipality_totals = summary_df.groupby('MUNICIPALITY')['CRASH_COUNT'].sum().sort_values(ascending=False)
+
+# Thread pool for heavy map renders, keeping them off the request threads used by the other callbacks
+os.makedirs(MAP_JOB_DIR, exist_ok=True)
+MAP_JOB_EXECUTOR = ThreadPoolExecutor(max_workers=MAP_JOB_THREADS)
+MAP_JOB_FUTURES = {}
+MAP_JOB_FUTURES_LOCK = threading.Lock()
+
 ### Dash App
 # Create app
 app = dash.Dash(
@@ -176,6 +587,11 @@ app = dash.Dash(
 )
 server = app.server
 
+# Report memory use of the worker that answers the request
+@server.route('/_worker-memory')
+def worker_memory():
+    return jsonify(read_process_memory())
+
 app.title = 'Pittsbugh Car Accident Explorer (2010 - 2019)'
 
 
@@ -184,6 +600,21 @@ controls = dbc.Card(
     [
         html.H3(['Control Panel']),
         html.P(['Use the controls below to filter the data and change how it is visualized! If the Scatter Plot radio button below is selected, you may change how the points are colored on the map by changing tabs in the bar plot panel in the bottom right corner of the screen.']),
+        dbc.FormGroup(
+            [
+                html.H5(['Municipality:']),
+                dcc.Dropdown(
+                    id='municipality',
+                    options=[
+                        {'label': '{} ({:,} crashes)'.format(municipality_label(municipality), count), 'value': int(municipality)} 
+                        for municipality, count in municipality_totals.items()
+                    ],
+                    value=DEFAULT_MUNICIPALITY,
+                    clearable=False,
+                    multi=False
+                ),
+            ], className='selector-group'
+        ),
         dbc.FormGroup(
             [
                 html.H5(['Hexbins or Heat Density Map']),
@@ -205,32 +636,8 @@ controls = dbc.Card(
                 html.H5(['Highlight Specific Characteristics:']),
                 dcc.Dropdown(
                     id='highlight-dropdown',
-                    options=[
-                        {'label': 'None', 'value': 0},
-                        {'label': 'Interstate', 'value': 'INTERSTATE'},
-                        {'label': 'State Road', 'value': 'STATE_ROAD'},
-                        {'label': 'Local Road', 'value': 'LOCAL_ROAD'},
-                        {'label': 'Work Zone', 'value': 'WORK_ZONE_IND'},
-                        {'label': 'School Zone', 'value': 'SCH_ZONE_IND'},
-                        {'label': 'Bicycle', 'value': 'BICYCLE'},
-                        {'label': 'Pedestrian', 'value': 'PEDESTRIAN'},
-                        {'label': 'Motorcycle', 'value': 'MOTORCYCLE'},
-                        {'label': 'Hazardous Truck', 'value': 'HAZARDOUS_TRUCK'},
-                        {'label': 'Heavy Truck', 'value': 'HVY_TRUCK_RELATED'},
-                        {'label': 'Deer', 'value': 'DEER_RELATED'},
-                        {'label': 'Unbelted Passengers/Driver', 'value': 'UNBELTED'},
-                        {'label': 'Unlicensed Driver', 'value': 'UNLICENSED'},
-                        {'label': 'Alcohol Related', 'value': 'ALCOHOL_RELATED'},
-                        {'label': 'Drug Related', 'value': 'DRUG_RELATED'},
-                        {'label': 'Cell Phone', 'value': 'CELL_PHONE'},
-                        {'label': 'Impaired Driver', 'value': 'IMPAIRED_DRIVER'},
-                        {'label': 'Distracted Driver', 'value': 'DISTRACTED'},
-                        {'label': 'Fatigue / Asleep', 'value': 'FATIGUE_ASLEEP'},
-                        {'label': 'Tailgating', 'value': 'TAILGATING'},
-                        {'label': 'Speeding', 'value': 'SPEEDING_RELATED'},
-                        {'label': 'Aggressive Driving', 'value': 'AGGRESSIVE_DRIVING'},
-                        {'label': 'Running a Red Light', 'value': 'RUNNING_RED_LT'},
-                        {'label': 'Curved Road', 'value': 'CURVED_ROAD'},
+                    options=[{'label': 'None', 'value': 0}] + [
+                        {'label': label, 'value': flag} for flag, label in flag_dict.items()
                     ],
                     value=0,
                     multi=False
@@ -244,14 +651,9 @@ controls = dbc.Card(
                     dcc.Dropdown(
                         id='cluster-dropdown',
                         options=[
-                            {'label': '0 - Local Road Daytime Impairment / Inclement Weather', 'value': 0},
-                            {'label': '1 - Local Road Aggressive Driving / Lack of Clearance ', 'value': 1},
-                            {'label': '2 - Large Road Nighttime Impairment / Inclement Weather', 'value': 2},
-                            {'label': '3 - Large Road Rear-End / Tailgating / Speeding - Injury-Causing', 'value': 3},
-                            {'label': '4 - Pedestrian / Motorcycle / Bicycle - Injury-Causing', 'value': 4},
-                            {'label': '5 - Local Road Intersection / Running a Red Light / Wet Roads', 'value': 5},
+                            {'label': label, 'value': cluster} for cluster, label in cluster_dict.items()
                         ],
-                        value=[0,1,2,3,4,5],
+                        value=list(cluster_dict),
                         multi=True
                     ),
                 ])
@@ -263,18 +665,9 @@ controls = dbc.Card(
                 dcc.Dropdown(
                     id='collision-type',
                     options=[
-                        {'label': 'Non-Collision', 'value': 0},
-                        {'label': 'Rear-End', 'value': 1},
-                        {'label': 'Head-On', 'value': 2},
-                        {'label': 'Rear-to-Rear (Backing)', 'value': 3},
-                        {'label': 'Angle', 'value': 4},
-                        {'label': 'Sideswipe (Same Direction)', 'value': 5},
-                        {'label': 'Sideswipe (Opposite Direction)', 'value': 6},
-                        {'label': 'Hit Fixed Object', 'value': 7},
-                        {'label': 'Hit Pedestrian', 'value': 8},
-                        {'label': 'Other or Unknown', 'value': 9},
+                        {'label': label, 'value': code} for code, label in collision_dict.items()
                     ],
-                    value=[0,1,2,3,4,5,6,7,8,9],
+                    value=list(collision_dict),
                     multi=True
                 ),
             ], className='selector-group dropdown-collision'
@@ -285,17 +678,9 @@ controls = dbc.Card(
                 dcc.Dropdown(
                     id='road-condition',
                     options=[
-                        {'label': 'Dry', 'value': 0},
-                        {'label': 'Wet', 'value': 1},
-                        {'label': 'Sand/Mud/Dirt/Oil/Gravel', 'value': 2},
-                        {'label': 'Snow Covered', 'value': 3},
-                        {'label': 'Slush', 'value': 4},
-                        {'label': 'Ice', 'value': 5},
-                        {'label': 'Ice Patches', 'value': 6},
-                        {'label': 'Water (Standing or Moving)', 'value': 7},
-                        {'label': 'Other or Unknown', 'value': 9},
+                        {'label': label, 'value': code} for code, label in condition_dict.items()
                     ],
-                    value=[0,1,2,3,4,5,6,7,9],
+                    value=list(condition_dict),
                     multi=True
                 ),
             ], className='selector-group dropdown-condition'
@@ -306,15 +691,9 @@ controls = dbc.Card(
                 dcc.Dropdown(
                     id='illumination',
                     options=[
-                        {'label': 'Daylight', 'value': 1},
-                        {'label': 'Dark - No Street Lights', 'value': 2},
-                        {'label': 'Dark - Street Lights', 'value': 3},
-                        {'label': 'Dusk', 'value': 4},
-                        {'label': 'Dawn', 'value': 5},
-                        {'label': 'Dark - Unknown Roadway Lighting', 'value': 6},
-                        {'label': 'Other or Unknown', 'value': 8}
+                        {'label': label, 'value': code} for code, label in illum_dict.items()
                     ],
-                    value=[1,2,3,4,5,6,8],
+                    value=list(illum_dict),
                     multi=True
                 ),
             ], className='selector-group dropdown-illumination'
@@ -325,16 +704,9 @@ controls = dbc.Card(
                 dcc.Dropdown(
                     id='relation',
                     options=[
-                        {'label': 'On Roadway', 'value': 1},
-                        {'label': 'Shoulder', 'value': 2},
-                        {'label': 'Median', 'value': 3},
-                        {'label': 'Roadside', 'value': 4},
-                        {'label': 'Outside Traficway', 'value': 5},
-                        {'label': 'In Parking Lane', 'value': 6},
-                        {'label': 'Intersection of Ramp/Highway', 'value': 7},
-                        {'label': 'Other or Unknown', 'value': 9}
+                        {'label': label, 'value': code} for code, label in relation_dict.items()
                     ],
-                    value=[1,2,3,4,5,6,7,9],
+                    value=list(relation_dict),
                     multi=True
                 ),
             ], className='selector-group dropdown-relation'
@@ -345,13 +717,9 @@ controls = dbc.Card(
                 dcc.Dropdown(
                     id='injury',
                     options=[
-                        {'label': 'No Reported Injuries/Deaths', 'value': 0},
-                        {'label': 'Minor Injury', 'value': 1},
-                        {'label': 'Moderate Injury', 'value': 2},
-                        {'label': 'Major Injury', 'value': 3},
-                        {'label': 'Fatal', 'value': 4},
+                        {'label': label, 'value': code} for code, label in injury_dict.items()
                     ],
-                    value=[0,1,2,3,4],
+                    value=list(injury_dict),
                     multi=True
                 ),
             ], className='selector-group dropdown-injury'
@@ -422,7 +790,12 @@ app.layout = dbc.Container(
                     controls,
                 ], md=4, align='start'),
                 dbc.Col([
-                    dbc.Card([dcc.Graph(id='crash-map')]),
+                    dbc.Card([
+                        dcc.Graph(id='crash-map'),
+                        dbc.Progress(id='map-job-progress', value=0, striped=True, animated=True, style={'height': '20px'}),
+                        dcc.Store(id='map-job'),
+                        dcc.Interval(id='map-job-poll', interval=MAP_JOB_POLL_MS, n_intervals=0, disabled=True)
+                    ]),
                     dbc.Row([
                         dbc.Col([
                             dbc.Card([dcc.Loading(children=dcc.Graph(id='crash-heat'))]),
@@ -463,7 +836,57 @@ app.layout = dbc.Container(
                                 html.Div(id='tab-content', className='p-4')
                             ], style={'padding':'10px'})
                         ])
-                    ])
+                    ]),
+                    dbc.Card([
+                        html.H5(['Crashes per Month']),
+                        dcc.RadioItems(
+                            id='trend-split',
+                            options=[
+                                {'label': 'All Crashes', 'value': 'none'},
+                                {'label': 'By K-Modes Cluster', 'value': 'cluster'},
+                                {'label': 'By Max Injury Severity', 'value': 'severity'}
+                            ],
+                            value='none',
+                            labelStyle={"margin-right": "20px"},
+                            inputStyle={"margin-right": "5px"}
+                        ),
+                        dcc.Loading(children=dcc.Graph(id='crash-trend'))
+                    ], style={'padding':'10px'}),
+                    dbc.Card([
+                        html.H5(['K-Modes Cluster Profile']),
+                        html.P(['Most common value of each feature within the cluster, or the share of crashes with each flag set, compared against all crashes in the selected year and month range.']),
+                        dcc.Dropdown(
+                            id='profile-cluster',
+                            options=[
+                                {'label': label, 'value': cluster} for cluster, label in cluster_dict.items()
+                            ],
+                            value=0,
+                            clearable=False,
+                            multi=False
+                        ),
+                        dcc.Loading(children=html.Div(id='cluster-profile', style={'maxHeight': '500px', 'overflowY': 'auto'}))
+                    ], style={'padding':'10px'}),
+                    dbc.Card([
+                        html.H5(['Crash Hotspots']),
+                        html.P(['Locations with dense clusters of crashes, ranked by the severity-weighted number of crashes matching the current filters.']),
+                        dcc.Dropdown(
+                            id='hotspot-count',
+                            options=[
+                                {'label': 'Top 10', 'value': 10},
+                                {'label': 'Top 25', 'value': 25},
+                                {'label': 'Top 50', 'value': 50}
+                            ],
+                            value=10,
+                            clearable=False,
+                            multi=False
+                        ),
+                        dcc.Loading(children=html.Div(id='hotspot-table', style={'maxHeight': '500px', 'overflowY': 'auto'}))
+                    ], style={'padding':'10px'}),
+                    dbc.Card([
+                        html.H5(['County Overview']),
+                        html.P(['Municipalities of Allegheny County with the most crashes in the selected year and month range.']),
+                        dcc.Loading(children=dcc.Graph(id='county-overview'))
+                    ], style={'padding':'10px'})
                     
                 ], md=8, align='start')
             ],
@@ -476,9 +899,9 @@ app.layout = dbc.Container(
 
 
 # Define callback functions
-# Update geo map
+# Start a background render of the geo map
 @app.callback(
-    Output('crash-map', component_property='figure'),
+    Output('map-job', component_property='data'),
     [
         Input('map-type', component_property='value'),
         Input('cluster-dropdown', component_property='value'),
@@ -491,79 +914,70 @@ app.layout = dbc.Container(
         Input('month-slider', component_property='value'),
         Input('highlight-dropdown', component_property='value'),
         Input('tabs', 'active_tab'),
-        State('crash-map', component_property='relayoutData')
+        Input('municipality', component_property='value'),
+        State('crash-map', component_property='relayoutData'),
+        State('map-job', component_property='data')
     ],
 )
 def update_geo_map(map_type, cluster_number, collision_type, 
                    road_condition, illumination, relation, 
                    injury, year_range, month_range, 
-                   highlight, active_tab, map_figure):
+                   highlight, active_tab, municipality, map_figure, map_job):
 
-    try:
-        current_zoom = (map_figure['mapbox.zoom'])
-        current_center_lat = (map_figure['mapbox.center']['lat'])
-        current_center_lon = (map_figure['mapbox.center']['lon'])
-    except:
-        current_zoom = 10
-        current_center_lat = CENTER_LAT
-        current_center_lon = CENTER_LON
-
-    df = get_data(cluster_number, collision_type, road_condition, illumination, relation, 
-                  injury, year_range, month_range, highlight)
+    # relayoutData only changes when the user pans or zooms, not when a new figure is drawn, so it is
+    # only used once it differs from the relayoutData seen by the previous render. Otherwise the map
+    # keeps the view of the previous render, or the municipality's default view after a switch
+    user_view = read_map_view(map_figure)
+    if not map_job or map_job['municipality'] != municipality:
+        current_center_lat, current_center_lon = municipality_center(municipality)
+        view = {'zoom': 10 if municipality == DEFAULT_MUNICIPALITY else 12, 'lat': current_center_lat, 'lon': current_center_lon}
+    elif user_view is not None and map_figure != map_job['relayout']:
+        view = user_view
+    else:
+        view = map_job['view']
 
-    if map_type == 2:
-        if active_tab == 'bar-illumination':
-            color_value = 'ILLUMINATION'
-            df = df.replace({color_value:illum_dict})
-            color_map = illum_color_map
-        elif active_tab == 'bar-condition': 
-            color_value = 'ROAD_CONDITION'
-            df = df.replace({color_value:condition_dict})
-            color_map = condition_color_map
-        elif active_tab == 'bar-relation':
-            color_value = 'RELATION_TO_ROAD'
-            df = df.replace({color_value:relation_dict})
-            color_map = relation_color_map
-        elif active_tab == 'bar-injury':
-            color_value = 'MAX_INJURY_SEVERITY'
-            df = df.replace({color_value:injury_dict})
-            color_map = injury_color_map
-        else:
-            color_value = 'COLLISION_TYPE'
-            df = df.replace({color_value:collision_dict})
-            color_map = collision_color_map
-            
-        fig = px.scatter_mapbox(df, lat='DEC_LAT', lon='DEC_LONG', 
-                                color=color_value, mapbox_style='stamen-terrain',
-                                color_discrete_map=color_map,
-                                zoom=current_zoom, 
-                                center=dict(lat=current_center_lat, lon=current_center_lon))
-        fig.layout.height = MAP_PANEL_HEIGHT
-        fig.update_layout(margin=dict(l=20, r=20, t=20, b=20))
+    session_id = map_job['session'] if map_job else uuid.uuid4().hex
+    filters = (cluster_number, collision_type, road_condition, illumination, relation, 
+               injury, year_range, month_range, highlight)
+    job_id = submit_map_job(session_id, municipality, filters, map_type, active_tab, 
+                            view['zoom'], view['lat'], view['lon'])
     
-    elif map_type == 1:
-        fig = px.density_mapbox(
-            df, lat='DEC_LAT', lon='DEC_LONG', radius=5,
-            center=dict(lat=current_center_lat, lon=current_center_lon), 
-            zoom=current_zoom, mapbox_style='stamen-terrain')
-        fig.layout.height = MAP_PANEL_HEIGHT
-        fig.update_layout(
-            margin=dict(l=20, r=20, t=20, b=20)
-        )
-        
-    elif map_type == 0:
-        fig = ff.create_hexbin_mapbox(
-            data_frame=df, lat="DEC_LAT", lon="DEC_LONG",
-            nx_hexagon=300, opacity=0.5, labels={"color": "# of Accidents"},
-            min_count=1, mapbox_style='stamen-terrain', show_original_data=True,
-            original_data_marker=dict(size=3, opacity=0.6, color='black'),
-            zoom=current_zoom, center=dict(lat=current_center_lat, lon=current_center_lon)
-        )
-        fig.layout.height = MAP_PANEL_HEIGHT
-        fig.update_layout(
-            margin=dict(l=20, r=20, t=20, b=20),
-        )
-    return fig
+    return {'session': session_id, 'job': job_id, 'municipality': municipality, 'view': view, 'relayout': map_figure}
+
+# Poll the background render and show the geo map once it is ready
+@app.callback(
+    Output('crash-map', component_property='figure'),
+    Output('map-job-poll', component_property='disabled'),
+    Output('map-job-progress', component_property='value'),
+    Output('map-job-progress', component_property='children'),
+    [
+        Input('map-job-poll', component_property='n_intervals'),
+        Input('map-job', component_property='data')
+    ],
+)
+def poll_geo_map(n_intervals, map_job):
+
+    if not map_job:
+        raise PreventUpdate
+    
+    status = read_map_job_status(map_job['job'])
+    
+    # Another poll (an interval tick racing the store change, or another worker) already delivered the map
+    if status['state'] == 'delivered':
+        raise PreventUpdate
+    elif status['state'] == 'done':
+        try:
+            with open(map_job_path(map_job['job'], 'figure')) as f:
+                fig = json.load(f)
+        except OSError:
+            raise PreventUpdate
+        mark_map_job_delivered(map_job['job'])
+        return fig, True, 100, ''
+    elif status['state'] in ('cancelled', 'failed'):
+        # Job files are left for clean_map_jobs, so repeated polls keep getting the same answer
+        return dash.no_update, True, 0, 'Map could not be rendered' if status['state'] == 'failed' else ''
+    
+    return dash.no_update, False, status['progress'], 'Rendering map... {}%'.format(status['progress'])
 
 # Update bar plots 
 @app.callback(
@@ -583,14 +997,15 @@ def update_geo_map(map_type, cluster_number, collision_type,
         Input('month-slider', component_property='value'),
         Input('highlight-dropdown', component_property='value'),
         Input('tabs', 'active_tab'),
+        Input('municipality', component_property='value'),
     ],
 )
 def update_bar(cluster_number, collision_type, 
                road_condition, illumination, relation, 
                injury, year_range, month_range, 
-               highlight, active_tab):
+               highlight, active_tab, municipality):
 
-    df = get_data(cluster_number, collision_type, road_condition, illumination, relation, 
+    df = get_data(load_municipality(municipality), cluster_number, collision_type, road_condition, illumination, relation, 
                   injury, year_range, month_range, highlight)
  
     if df.shape[0] < 2:
@@ -662,15 +1077,16 @@ def update_bar(cluster_number, collision_type,
         Input('injury', component_property='value'),
         Input('year-slider', component_property='value'),
         Input('month-slider', component_property='value'),
-        Input('highlight-dropdown', component_property='value')
+        Input('highlight-dropdown', component_property='value'),
+        Input('municipality', component_property='value')
     ],
 )
 def update_bar_and_heat(cluster_number, collision_type, 
                         road_condition, illumination, relation, 
                         injury, year_range, month_range, 
-                        highlight):
+                        highlight, municipality):
 
-    df = get_data(cluster_number, collision_type, road_condition, illumination, relation, 
+    df = get_data(load_municipality(municipality), cluster_number, collision_type, road_condition, illumination, relation, 
                   injury, year_range, month_range, highlight)
     
     day_hour_heatmap = generate_heatmap(df)
@@ -690,6 +1106,228 @@ def update_bar_and_heat(cluster_number, collision_type,
     
     return heat_fig
 
+# Update monthly trend
+@app.callback(
+    Output('crash-trend', component_property='figure'),
+    [
+        Input('cluster-dropdown', component_property='value'),
+        Input('collision-type', component_property='value'),
+        Input('road-condition', component_property='value'),
+        Input('illumination', component_property='value'),
+        Input('relation', component_property='value'),
+        Input('injury', component_property='value'),
+        Input('year-slider', component_property='value'),
+        Input('month-slider', component_property='value'),
+        Input('highlight-dropdown', component_property='value'),
+        Input('trend-split', component_property='value'),
+        Input('municipality', component_property='value')
+    ],
+)
+def update_trend(cluster_number, collision_type, 
+                 road_condition, illumination, relation, 
+                 injury, year_range, month_range, 
+                 highlight, split, municipality):
+
+    data = load_municipality(municipality)
+
+    # Cluster, severity, year and month are axes of the precomputed counts, so
+    # only the remaining filters require counting the filtered rows
+    if (not highlight and is_unfiltered(collision_type, collision_dict) 
+            and is_unfiltered(road_condition, condition_dict) 
+            and is_unfiltered(illumination, illum_dict) 
+            and is_unfiltered(relation, relation_dict)):
+        counts = data['trend_counts']
+    else:
+        df = get_data(data, cluster_number, collision_type, road_condition, illumination, relation, 
+                      injury, year_range, month_range, highlight)
+        counts = build_trend_counts(df)
+    
+    counts = counts[year_range[0] - YEAR_MIN:year_range[1] - YEAR_MIN + 1, month_range[0] - 1:month_range[1]]
+    counts = counts[:, :, cluster_number, :][:, :, :, injury]
+    
+    if counts.sum() == 0:
+        return FIG_NONE
+    
+    years = np.arange(year_range[0], year_range[1] + 1)
+    months = np.arange(month_range[0], month_range[1] + 1)
+    dates = pd.to_datetime(pd.DataFrame({
+        'year': np.repeat(years, len(months)),
+        'month': np.tile(months, len(years)),
+        'day': 1
+    }))
+    
+    if split == 'cluster':
+        counts = counts.sum(axis=3)
+        categories = ['Cluster {}'.format(c) for c in cluster_number]
+        color_map = cluster_color_map
+    elif split == 'severity':
+        counts = counts.sum(axis=2)
+        categories = [injury_dict[i] for i in injury]
+        color_map = injury_color_map
+    else:
+        counts = counts.sum(axis=(2, 3))[:, :, np.newaxis]
+        categories = ['All Crashes']
+        color_map = {'All Crashes': DISCRETE_COLORS[0]}
+    
+    trend_df = pd.DataFrame({
+        'MONTH': np.repeat(dates.values, len(categories)),
+        'CATEGORY': np.tile(categories, len(dates)),
+        'COUNT': counts.reshape(-1)
+    })
+    
+    trend_fig = px.line(trend_df, 
+                        x='MONTH', 
+                        y='COUNT', 
+                        color='CATEGORY', 
+                        color_discrete_map=color_map,
+                        labels={'MONTH': 'Month', 'COUNT': '# of Accidents', 'CATEGORY': ''})
+    trend_fig.update_traces(mode='lines+markers')
+    trend_fig.update_layout(
+        margin=dict(l=20, r=20, t=20, b=20),
+        showlegend=(split != 'none')
+    )
+    
+    return trend_fig
+
+# Update cluster profile
+@app.callback(
+    Output('cluster-profile', component_property='children'),
+    [
+        Input('profile-cluster', component_property='value'),
+        Input('year-slider', component_property='value'),
+        Input('month-slider', component_property='value'),
+        Input('municipality', component_property='value')
+    ],
+)
+def update_cluster_profile(profile_cluster, year_range, month_range, municipality):
+
+    rows = []
+    for feature, (values, counts) in load_municipality(municipality)['profile_counts'].items():
+        counts = counts[year_range[0] - YEAR_MIN:year_range[1] - YEAR_MIN + 1, month_range[0] - 1:month_range[1]].sum(axis=(0, 1))
+        all_counts = counts.sum(axis=0)
+        cluster_counts = counts[profile_cluster]
+        
+        if cluster_counts.sum() == 0:
+            continue
+        
+        if feature in flag_dict:
+            value_index = np.searchsorted(values, 1)
+            if value_index == len(values) or values[value_index] != 1:
+                continue
+            feature_name = flag_dict[feature]
+            value_label = 'Yes'
+        else:
+            value_index = cluster_counts.argmax()
+            feature_name, label_dict = profile_feature_dict[feature]
+            value_label = label_dict.get(values[value_index], values[value_index])
+        
+        prevalence = cluster_counts[value_index] / cluster_counts.sum()
+        all_prevalence = all_counts[value_index] / all_counts.sum()
+        rows.append({
+            'Feature': feature_name,
+            'Value': value_label,
+            'Prevalence': prevalence,
+            'All Crashes': all_prevalence,
+            'Lift': prevalence / all_prevalence if all_prevalence > 0 else np.nan
+        })
+    
+    if len(rows) == 0:
+        return html.P(['Not Enough Data to Display'])
+    
+    profile_table = pd.DataFrame(rows).sort_values(by='Lift', ascending=False)
+    profile_table['Prevalence'] = profile_table['Prevalence'].map('{:.1%}'.format)
+    profile_table['All Crashes'] = profile_table['All Crashes'].map('{:.1%}'.format)
+    profile_table['Lift'] = profile_table['Lift'].map('{:.2f}'.format)
+    
+    return dbc.Table.from_dataframe(profile_table, striped=True, hover=True, size='sm')
+
+# Update hotspot table
+@app.callback(
+    Output('hotspot-table', component_property='children'),
+    [
+        Input('cluster-dropdown', component_property='value'),
+        Input('collision-type', component_property='value'),
+        Input('road-condition', component_property='value'),
+        Input('illumination', component_property='value'),
+        Input('relation', component_property='value'),
+        Input('injury', component_property='value'),
+        Input('year-slider', component_property='value'),
+        Input('month-slider', component_property='value'),
+        Input('highlight-dropdown', component_property='value'),
+        Input('hotspot-count', component_property='value'),
+        Input('municipality', component_property='value')
+    ],
+)
+def update_hotspots(cluster_number, collision_type, 
+                    road_condition, illumination, relation, 
+                    injury, year_range, month_range, 
+                    highlight, hotspot_count, municipality):
+
+    data = load_municipality(municipality)
+    mask = get_mask(data, cluster_number, collision_type, road_condition, illumination, relation, 
+                    injury, year_range, month_range, highlight)
+    
+    hotspot_table = data['hotspot_df'][['STREET_NAME', 'DEC_LAT', 'DEC_LONG']].copy()
+    hotspot_table['CRASH_COUNT'] = sum_members(mask.astype(int), data['hotspot_order'], data['hotspot_offsets'])
+    hotspot_table['SEVERITY_SCORE'] = sum_members(np.where(mask, data['crash_severity_weights'], 0), data['hotspot_order'], data['hotspot_offsets'])
+    hotspot_table = hotspot_table.loc[hotspot_table['CRASH_COUNT'] > 0]
+    
+    if len(hotspot_table) == 0:
+        return html.P(['Not Enough Data to Display'])
+    
+    hotspot_table = hotspot_table.sort_values(by=['SEVERITY_SCORE', 'CRASH_COUNT'], ascending=False, kind='stable').head(hotspot_count)
+    hotspot_table.insert(0, 'RANK', np.arange(1, len(hotspot_table) + 1))
+    hotspot_table['DEC_LAT'] = hotspot_table['DEC_LAT'].round(5)
+    hotspot_table['DEC_LONG'] = hotspot_table['DEC_LONG'].round(5)
+    hotspot_table = hotspot_table.rename(columns={
+        'RANK': 'Rank',
+        'STREET_NAME': 'Street',
+        'DEC_LAT': 'Latitude',
+        'DEC_LONG': 'Longitude',
+        'CRASH_COUNT': '# of Accidents',
+        'SEVERITY_SCORE': 'Severity Score'
+    })
+    
+    return dbc.Table.from_dataframe(hotspot_table, striped=True, hover=True, size='sm')
+
+# Update county overview
+@app.callback(
+    Output('county-overview', component_property='figure'),
+    [
+        Input('year-slider', component_property='value'),
+        Input('month-slider', component_property='value'),
+        Input('municipality', component_property='value')
+    ],
+)
+def update_county_overview(year_range, month_range, municipality):
+
+    df = summary_df.loc[(summary_df['CRASH_YEAR'] >= year_range[0]) & (summary_df['CRASH_YEAR'] <= year_range[1])]
+    df = df.loc[(df['CRASH_MONTH'] >= month_range[0]) & (df['CRASH_MONTH'] <= month_range[1])]
+    df = df.groupby('MUNICIPALITY')[['CRASH_COUNT', 'INJURY_COUNT', 'FATAL_COUNT']].sum()
+    df = df.sort_values(by='CRASH_COUNT', ascending=False).head(COUNTY_OVERVIEW_COUNT).reset_index()
+    
+    if len(df) == 0:
+        return FIG_NONE
+    
+    df['NAME'] = df['MUNICIPALITY'].map(municipality_label)
+    df['SELECTED'] = np.where(df['MUNICIPALITY'] == municipality, 'Selected', 'Other')
+    
+    overview_fig = px.bar(df, 
+                          x='NAME', 
+                          y='CRASH_COUNT', 
+                          color='SELECTED',
+                          color_discrete_map={'Selected': DISCRETE_COLORS[1], 'Other': DISCRETE_COLORS[0]},
+                          hover_data={'INJURY_COUNT': True, 'FATAL_COUNT': True, 'SELECTED': False},
+                          labels={'NAME': 'Municipality', 'CRASH_COUNT': '# of Accidents', 
+                                  'INJURY_COUNT': '# Causing Injury', 'FATAL_COUNT': '# Fatal'})
+    overview_fig.update_layout(
+        margin=dict(l=20, r=20, t=20, b=20),
+        xaxis=dict(tickfont=dict(size=10), categoryorder='total descending'),
+        showlegend=False
+    )
+    
+    return overview_fig
+
 # Run app
 if __name__ == '__main__':
     app.run_server(debug=True, use_reloader=False)
\ No newline at end of file
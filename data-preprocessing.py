@@ -1,8 +1,11 @@
+import os
+
 import numpy as np
 import pandas as pd
 from kmodes.kmodes import KModes
 from tqdm import tqdm
-from sklearn.preprocessing import LabelEncoder
+
+import recode_spec
 
 pd.set_option("display.max_rows", 100)
 
@@ -15,21 +18,23 @@ crash_df = pd.read_csv('data/crash-data.csv', low_memory=False)
 crash_df = crash_df.loc[(crash_df['DEC_LONG'] < -79.7) & (crash_df['DEC_LONG'] > -80.4)].reset_index(drop=True)
 crash_df = crash_df.loc[(crash_df['DEC_LAT'] < 40.7) & (crash_df['DEC_LAT'] > 40.2)].reset_index(drop=True)
 
-### Filter for City of Pittsburgh
-crash_df = crash_df.loc[crash_df['MUNICIPALITY'] == 2301].reset_index(drop=True)
+### Municipality whose crashes the k-modes clusters are fit on (City of Pittsburgh)
+PITTSBURGH = 2301
 
 
 
 drop_cols = []
 
-### Remove columns with only one unique value
-for col in crash_df.columns:
-    if len(crash_df[col].unique()) == 1:
+### Remove columns with only one unique value in the City of Pittsburgh, so the clustering features stay the same
+### (MUNICIPALITY is always constant there but is needed to partition the county)
+pittsburgh_crash_df = crash_df.loc[crash_df['MUNICIPALITY'] == PITTSBURGH]
+for col in crash_df.columns.drop('MUNICIPALITY'):
+    if len(pittsburgh_crash_df[col].unique()) == 1:
         drop_cols.append(col)
 
 ### Select additional columns to drop from dataset
 additional_drop_cols = [
-    'MUNICIPALITY', 'POLICE_AGCY', 'LATITUDE', 'LONGITUDE', 'ACCESS_CTRL', 'STREET_NAME',
+    'POLICE_AGCY', 'LATITUDE', 'LONGITUDE', 'ACCESS_CTRL', 'STREET_NAME',
     'FLAG_CRN', 'ROADWAY_CRN', 'RDWY_SEQ_NUM', 'ADJ_RDWY_SEQ', 'ROADWAY_COUNTY',
     'ROAD_OWNER', 'ROUTE', 'SEGMENT', 'OFFSET', 'LN_CLOSE_DIR', 'SCHOOL_BUS_UNIT',
     'RDWY_SURF_TYPE_CD', 'SPEC_JURIS_CD', 'WORK_ZONE_TYPE', 'WORK_ZONE_LOC', 'CONS_ZONE_SPD_LIM', 
@@ -56,32 +61,15 @@ drop_cols += numeric_drop_cols
 cat_crash_df = crash_df[crash_df['CRASH_YEAR'] > 2009].drop(drop_cols, axis=1).reset_index(drop=True)
 
 
-### Impute missing values
-
-cat_crash_df['HOUR_OF_DAY'] = cat_crash_df['HOUR_OF_DAY'].fillna(99)
-cat_crash_df['WEATHER'] = cat_crash_df['WEATHER'].fillna(1)
-cat_crash_df['ROAD_CONDITION'] = cat_crash_df['ROAD_CONDITION'].fillna(1)
-cat_crash_df['SCH_BUS_IND'] = cat_crash_df['SCH_BUS_IND'].fillna('N')
-cat_crash_df['SCH_ZONE_IND'] = cat_crash_df['SCH_ZONE_IND'].fillna('N')
-cat_crash_df['NTFY_HIWY_MAINT'] = cat_crash_df['NTFY_HIWY_MAINT'].fillna('N')
-cat_crash_df['TFC_DETOUR_IND'] = cat_crash_df['TFC_DETOUR_IND'].fillna('N')
-cat_crash_df['MODERATE_INJURY'] = cat_crash_df['MODERATE_INJURY'].fillna(0)
-cat_crash_df['RDWY_ORIENT'] = cat_crash_df['RDWY_ORIENT'].fillna('U')
-cat_crash_df['LOCAL_ROAD'] = cat_crash_df['LOCAL_ROAD'].fillna(cat_crash_df['LOCAL_ROAD_ONLY'])
-cat_crash_df.loc[cat_crash_df['RDWY_ORIENT'] == 'B', 'RDWY_ORIENT'] = 'U'
+### Impute missing values and label encode non-numeric categorical variables, as declared in recode_spec.py
+cat_crash_df, recode_report = recode_spec.apply_clean(cat_crash_df)
 
 cat_crash_df = cat_crash_df.dropna()
-
-
-### Label encode non-numeric categorical variables
-encode_columns = ['SCH_BUS_IND', 'SCH_ZONE_IND', 'NTFY_HIWY_MAINT', 'RDWY_ORIENT', 'WORK_ZONE_IND', 'TFC_DETOUR_IND']
-
-for col in encode_columns:
-    le = LabelEncoder()
-    cat_crash_df[col] = le.fit_transform(cat_crash_df[col])
+cat_crash_df = cat_crash_df.astype({column: int for column in ['MUNICIPALITY'] + recode_spec.ENCODED_COLUMNS})
 
 
 ### Perform k-modes clustering (n_clusters and init optimized previously)
+### Clusters are fit on the City of Pittsburgh and other municipalities are assigned to the nearest cluster
 
 kmode = KModes(
         n_clusters=6, 
@@ -90,25 +78,112 @@ kmode = KModes(
         random_state=73
     )
 
-cat_crash_df['KMODE_CLUSTER'] = kmode.fit_predict(cat_crash_df.drop(['CRASH_CRN', 'CRASH_YEAR', 'DEC_LAT', 'DEC_LONG',], axis=1))
+cluster_features = cat_crash_df.drop(['CRASH_CRN', 'CRASH_YEAR', 'DEC_LAT', 'DEC_LONG', 'MUNICIPALITY'], axis=1)
+kmode.fit(cluster_features.loc[cat_crash_df['MUNICIPALITY'] == PITTSBURGH])
+cat_crash_df['KMODE_CLUSTER'] = kmode.predict(cluster_features)
 
 
-### COLLISION_TYPE - reclassify 98 (other) and 99 (unknown) as 9 (other/unknown)
-cat_crash_df.loc[cat_crash_df['COLLISION_TYPE'] == 98, 'COLLISION_TYPE'] = 9 
-cat_crash_df.loc[cat_crash_df['COLLISION_TYPE'] == 99, 'COLLISION_TYPE'] = 9 
+### Reclassify other / unknown COLLISION_TYPE and ROAD_CONDITION codes as 9 and derive MAX_INJURY_SEVERITY
+cat_crash_df, report = recode_spec.apply_recode(cat_crash_df)
+recode_report += report
 
-### ROAD_CONDITION - reclassify 98 (other) and 99 (unknown) as 9 (other/unknown)
-cat_crash_df.loc[cat_crash_df['ROAD_CONDITION'] == 22.0, 'ROAD_CONDITION'] = 9.0 
-cat_crash_df.loc[cat_crash_df['ROAD_CONDITION'] == 98.0, 'ROAD_CONDITION'] = 9.0 
-cat_crash_df.loc[cat_crash_df['ROAD_CONDITION'] == 99.0, 'ROAD_CONDITION'] = 9.0 
-cat_crash_df.loc[cat_crash_df['ROAD_CONDITION'] == 8.0, 'ROAD_CONDITION'] = 9.0 
+### Report how many values each column imputed, remapped and could not map to a known code
+print(pd.DataFrame(recode_report).to_string(index=False))
 
-### Create categorical 
-cat_crash_df['MAX_INJURY_SEVERITY'] = 0
-cat_crash_df.loc[cat_crash_df['MINOR_INJURY'] == 1, 'MAX_INJURY_SEVERITY'] = 1
-cat_crash_df.loc[cat_crash_df['MODERATE_INJURY'] == 1, 'MAX_INJURY_SEVERITY'] = 2
-cat_crash_df.loc[cat_crash_df['MAJOR_INJURY'] == 1, 'MAX_INJURY_SEVERITY'] = 3
-cat_crash_df.loc[cat_crash_df['FATAL'] == 1, 'MAX_INJURY_SEVERITY'] = 4
+
+### Count crashes per year, month, k-modes cluster, feature and value for the dashboard cluster profile
+profile_features = recode_spec.LABELLED_COLUMNS + list(recode_spec.FLAG_LABELS)
+
+def count_profile(df):
+    profile_df = df.melt(
+        id_vars=['CRASH_YEAR', 'CRASH_MONTH', 'KMODE_CLUSTER'], 
+        value_vars=profile_features, 
+        var_name='FEATURE', 
+        value_name='VALUE'
+    )
+    
+    return profile_df.groupby(['CRASH_YEAR', 'CRASH_MONTH', 'KMODE_CLUSTER', 'FEATURE', 'VALUE']).size().reset_index(name='COUNT')
+
+
+### Detect crash hotspots - hash each crash onto a metric grid, keep cells with at least 
+### HOTSPOT_MIN_CRASHES crashes and merge neighbouring dense cells into one hotspot
+HOTSPOT_CELL_METERS = 50
+HOTSPOT_MIN_CRASHES = 10
+EARTH_RADIUS_METERS = 6371000
+
+# Street names are dropped from the clean data but label the hotspots
+street_names = crash_df.drop_duplicates('CRASH_CRN').set_index('CRASH_CRN')['STREET_NAME']
+
+def detect_hotspots(df):
+    lat_radians = np.radians(df['DEC_LAT'].values)
+    long_radians = np.radians(df['DEC_LONG'].values)
+    cell_df = pd.DataFrame({
+        'CELL_X': np.floor(long_radians * np.cos(lat_radians.mean()) * EARTH_RADIUS_METERS / HOTSPOT_CELL_METERS).astype(int),
+        'CELL_Y': np.floor(lat_radians * EARTH_RADIUS_METERS / HOTSPOT_CELL_METERS).astype(int)
+    })
+    cell_groups = cell_df.groupby(['CELL_X', 'CELL_Y'])
+    cell_ids = cell_groups.ngroup().values
+    cell_counts = cell_groups.size()
+
+    dense_cells = set(cell_counts.index[cell_counts.values >= HOTSPOT_MIN_CRASHES])
+    cell_hotspot = {}
+    n_hotspots = 0
+    for cell in dense_cells:
+        if cell in cell_hotspot:
+            continue
+        hotspot = n_hotspots
+        n_hotspots += 1
+        cell_hotspot[cell] = hotspot
+        stack = [cell]
+        while stack:
+            cell_x, cell_y = stack.pop()
+            for dx in (-1, 0, 1):
+                for dy in (-1, 0, 1):
+                    neighbour = (cell_x + dx, cell_y + dy)
+                    if neighbour in dense_cells and neighbour not in cell_hotspot:
+                        cell_hotspot[neighbour] = hotspot
+                        stack.append(neighbour)
+
+    cell_hotspot_ids = np.array([cell_hotspot.get(cell, -1) for cell in cell_counts.index])[cell_ids]
+
+    # Renumber hotspots so that HOTSPOT_ID 0 has the highest severity-weighted score
+    in_hotspot = cell_hotspot_ids >= 0
+    hotspot_scores = np.bincount(
+        cell_hotspot_ids[in_hotspot], 
+        weights=recode_spec.SEVERITY_WEIGHTS[df['MAX_INJURY_SEVERITY'].values[in_hotspot]], 
+        minlength=n_hotspots
+    )
+    hotspot_rank = np.empty(n_hotspots, dtype=int)
+    hotspot_rank[np.argsort(-hotspot_scores, kind='stable')] = np.arange(n_hotspots)
+    hotspot_ids = np.full(len(df), -1)
+    hotspot_ids[in_hotspot] = hotspot_rank[cell_hotspot_ids[in_hotspot]]
+
+    # Summarize each hotspot, labelled with its most common street name
+    hotspot_df = df.loc[in_hotspot, ['DEC_LAT', 'DEC_LONG', 'MAX_INJURY_SEVERITY']].copy()
+    hotspot_df['HOTSPOT_ID'] = hotspot_ids[in_hotspot]
+    hotspot_df['SEVERITY_SCORE'] = recode_spec.SEVERITY_WEIGHTS[hotspot_df['MAX_INJURY_SEVERITY'].values]
+    hotspot_df['STREET_NAME'] = df.loc[in_hotspot, 'CRASH_CRN'].map(street_names)
+    hotspot_df = hotspot_df.groupby('HOTSPOT_ID').agg(
+        DEC_LAT=('DEC_LAT', 'mean'),
+        DEC_LONG=('DEC_LONG', 'mean'),
+        CRASH_COUNT=('DEC_LAT', 'size'),
+        SEVERITY_SCORE=('SEVERITY_SCORE', 'sum'),
+        STREET_NAME=('STREET_NAME', lambda names: names.value_counts().index[0] if names.notna().any() else 'Unknown')
+    ).reset_index()
+    
+    return hotspot_ids, hotspot_df
+
+
+### Assign crashes with identical coordinates to a shared location so the dashboard maps can draw one marker per location
+def assign_locations(df):
+    location_ids = df.groupby(['DEC_LAT', 'DEC_LONG']).ngroup().values
+    location_df = pd.DataFrame({
+        'LOCATION_ID': location_ids, 
+        'DEC_LAT': df['DEC_LAT'].values, 
+        'DEC_LONG': df['DEC_LONG'].values
+    }).drop_duplicates('LOCATION_ID').sort_values(by='LOCATION_ID')
+    
+    return location_ids, location_df
 
 
 ### Filter for features that will be used by the dashboard app
@@ -140,6 +215,7 @@ final_features = [
     'UNLICENSED',
     'UNBELTED',
     'DISTRACTED',
+    'CELL_PHONE',
     'CURVED_ROAD',
     'IMPAIRED_DRIVER',
     'FATIGUE_ASLEEP',
@@ -149,22 +225,34 @@ final_features = [
     'RUNNING_RED_LT',
     'TAILGATING',
     'DEC_LAT',
-    'DEC_LONG'
+    'DEC_LONG',
+    'HOTSPOT_ID',
+    'LOCATION_ID'
 ]
 
-cat_crash_df = cat_crash_df[final_features]
-
-
-### Save dataframe
-cat_crash_df.to_csv('data/clean-crash-data.csv', index=False)
-
-
-
-
-
-
-
-
-
-
 
+### Summarize crashes per municipality, year and month for the dashboard county overview
+summary_df = cat_crash_df.assign(
+    INJURY_COUNT=(cat_crash_df['MAX_INJURY_SEVERITY'] > 0).astype(int),
+    FATAL_COUNT=(cat_crash_df['MAX_INJURY_SEVERITY'] == 4).astype(int)
+).groupby(['MUNICIPALITY', 'CRASH_YEAR', 'CRASH_MONTH']).agg(
+    CRASH_COUNT=('CRASH_CRN', 'size'),
+    INJURY_COUNT=('INJURY_COUNT', 'sum'),
+    FATAL_COUNT=('FATAL_COUNT', 'sum')
+).reset_index()
+
+summary_df.to_csv('data/municipality-summary.csv', index=False)
+
+
+### Save one partition per municipality, with the hotspots, locations and cluster profile the dashboard loads alongside it
+for municipality, municipality_df in tqdm(cat_crash_df.groupby('MUNICIPALITY')):
+    municipality_df = municipality_df.reset_index(drop=True)
+    municipality_df['HOTSPOT_ID'], hotspot_df = detect_hotspots(municipality_df)
+    municipality_df['LOCATION_ID'], location_df = assign_locations(municipality_df)
+    
+    partition_dir = os.path.join('data', 'municipalities', str(municipality))
+    os.makedirs(partition_dir, exist_ok=True)
+    municipality_df[final_features].to_csv(os.path.join(partition_dir, 'clean-crash-data.csv'), index=False)
+    count_profile(municipality_df).to_csv(os.path.join(partition_dir, 'cluster-profile.csv'), index=False)
+    hotspot_df.to_csv(os.path.join(partition_dir, 'hotspots.csv'), index=False)
+    location_df.to_csv(os.path.join(partition_dir, 'locations.csv'), index=False)
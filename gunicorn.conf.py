@@ -0,0 +1,25 @@
+import multiprocessing
+import os
+
+### gunicorn settings
+# The app is imported once in the master process before workers are forked. Workers inherit the
+# derived arrays built at import copy-on-write and memory-map the same crash data files, so adding
+# workers mostly costs CPU rather than another copy of the dataset.
+
+preload_app = True
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+
+
+# Log each worker's memory once it is ready to serve requests
+def post_worker_init(worker):
+    from app import read_process_memory
+
+    memory = read_process_memory()
+    worker.log.info(
+        'Worker %s memory: RSS %.1f MB, PSS %.1f MB, shared %.1f MB, private %.1f MB',
+        worker.pid,
+        memory.get('VmRSS', float('nan')),
+        memory.get('Pss', float('nan')),
+        memory.get('Shared_Clean', 0) + memory.get('Shared_Dirty', 0),
+        memory.get('Private_Clean', 0) + memory.get('Private_Dirty', 0)
+    )
@@ -0,0 +1,471 @@
+import argparse
+import csv
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import recode_spec
+
+
+### Replay dashboard interactions against a locally started gunicorn server
+#
+# Example:
+#   python load-test.py --workers 1 2 4 --threads 1 4 --users 16 --duration 60
+#
+# Each user session replays a sequence of control changes (slider drags, dropdown
+# edits, map type switches, tab changes and municipality switches). Every change is sent the way the Dash
+# renderer sends it: one _dash-update-component POST per callback that takes the
+# changed property as an input, followed by the callbacks chained off their outputs.
+# Enabled dcc.Interval components are then ticked until they disable themselves, so
+# background map renders are measured from the change until the map is delivered.
+# Municipality switches also report their total time as 'municipality switch (total)',
+# which includes reading partitions that are not yet cached by the worker.
+# After each run the memory of every worker is read from /_worker-memory.
+# Sessions are generated from --seed unless a recorded --sessions file is given.
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+YEAR_RANGE = [2010, 2019]
+MONTH_RANGE = [1, 12]
+# Multi-select dropdown options, taken from the recode specification the dashboard builds them from
+MULTI_DROPDOWNS = {
+    'cluster-dropdown': [0, 1, 2, 3, 4, 5],
+    'collision-type': list(recode_spec.label_dict('COLLISION_TYPE')),
+    'road-condition': list(recode_spec.label_dict('ROAD_CONDITION')),
+    'illumination': list(recode_spec.label_dict('ILLUMINATION')),
+    'relation': list(recode_spec.label_dict('RELATION_TO_ROAD')),
+    'injury': list(recode_spec.label_dict('MAX_INJURY_SEVERITY')),
+}
+HIGHLIGHTS = [0, 'INTERSTATE', 'PEDESTRIAN', 'BICYCLE', 'ALCOHOL_RELATED', 'SPEEDING_RELATED', 'DISTRACTED']
+TABS = ['bar-illumination', 'bar-condition', 'bar-relation', 'bar-collision', 'bar-injury']
+MAP_TYPES = [0, 1, 2]
+DEFAULT_MUNICIPALITY = 2301
+
+# Delay between the intermediate values the browser sends while a slider is dragged
+DRAG_PAUSE = 0.15
+
+# Delay between separate user actions
+THINK_PAUSE = (0.5, 2.0)
+
+
+### Session generation
+
+# Municipalities with the most crashes, read from the county summary written by data-preprocessing.py
+def read_municipalities(n_municipalities):
+    totals = {}
+    with open(os.path.join(REPO_DIR, 'data', 'municipality-summary.csv')) as f:
+        for row in csv.DictReader(f):
+            municipality = int(row['MUNICIPALITY'])
+            totals[municipality] = totals.get(municipality, 0) + int(row['CRASH_COUNT'])
+
+    return sorted(totals, key=totals.get, reverse=True)[:n_municipalities]
+
+# Drag one end of a range slider from its current position to a new one
+def slider_drag(rng, component_id, current, bounds):
+    end = rng.randrange(2)
+    if end == 0:
+        target = rng.randint(bounds[0], current[1])
+    else:
+        target = rng.randint(current[0], bounds[1])
+    step = 1 if target >= current[end] else -1
+
+    steps = []
+    value = list(current)
+    for position in range(current[end] + step, target + step, step):
+        value[end] = position
+        steps.append({'id': component_id, 'property': 'value', 'value': list(value), 'pause': DRAG_PAUSE, 'wait': False})
+    if steps:
+        steps[-1]['wait'] = True
+
+    return steps, value
+
+# Add or remove one option from a multi-select dropdown
+def dropdown_edit(rng, component_id, current):
+    options = MULTI_DROPDOWNS[component_id]
+    missing = [option for option in options if option not in current]
+    if missing and (len(current) <= 1 or rng.random() < 0.5):
+        value = sorted(current + [rng.choice(missing)])
+    else:
+        removed = rng.choice(current)
+        value = [option for option in current if option != removed]
+
+    return {'id': component_id, 'property': 'value', 'value': value, 'pause': rng.uniform(*THINK_PAUSE)}, value
+
+# Generate one user session as a list of property changes
+def generate_session(rng, n_actions, municipalities):
+    state = {
+        'year-slider': list(YEAR_RANGE),
+        'month-slider': list(MONTH_RANGE),
+        'municipality': DEFAULT_MUNICIPALITY,
+    }
+    state.update({component_id: list(options) for component_id, options in MULTI_DROPDOWNS.items()})
+
+    session = []
+    for _ in range(n_actions):
+        action = rng.choices(['year', 'month', 'dropdown', 'highlight', 'map', 'tab', 'municipality'], weights=[3, 2, 3, 1, 1, 2, 1])[0]
+        others = [municipality for municipality in municipalities if municipality != state['municipality']]
+        if action == 'municipality' and not others:
+            action = 'tab'
+        if action == 'year':
+            steps, state['year-slider'] = slider_drag(rng, 'year-slider', state['year-slider'], YEAR_RANGE)
+            session += steps
+        elif action == 'month':
+            steps, state['month-slider'] = slider_drag(rng, 'month-slider', state['month-slider'], MONTH_RANGE)
+            session += steps
+        elif action == 'dropdown':
+            component_id = rng.choice(list(MULTI_DROPDOWNS))
+            step, state[component_id] = dropdown_edit(rng, component_id, state[component_id])
+            session.append(step)
+        elif action == 'highlight':
+            session.append({'id': 'highlight-dropdown', 'property': 'value', 'value': rng.choice(HIGHLIGHTS), 'pause': rng.uniform(*THINK_PAUSE)})
+        elif action == 'municipality':
+            state['municipality'] = rng.choice(others)
+            session.append({'id': 'municipality', 'property': 'value', 'value': state['municipality'], 'pause': rng.uniform(*THINK_PAUSE)})
+        elif action == 'map':
+            session.append({'id': 'map-type', 'property': 'value', 'value': rng.choice(MAP_TYPES), 'pause': rng.uniform(*THINK_PAUSE)})
+        else:
+            session.append({'id': 'tabs', 'property': 'active_tab', 'value': rng.choice(TABS), 'pause': rng.uniform(*THINK_PAUSE)})
+
+    return session
+
+
+### Dash client
+
+# Collect the initial property values and the type of every component with an id in the layout
+def collect_props(node, values, types):
+    if isinstance(node, list):
+        for child in node:
+            collect_props(child, values, types)
+    elif isinstance(node, dict):
+        props = node.get('props', {})
+        if 'id' in props and isinstance(props['id'], str):
+            types[props['id']] = node.get('type')
+            for prop, value in props.items():
+                values[(props['id'], prop)] = value
+        for value in props.values():
+            if isinstance(value, (dict, list)):
+                collect_props(value, values, types)
+
+# Split a callback output string, e.g. "crash-map.figure" or "..a.figure...b.figure..", into (id, prop) pairs
+def parse_outputs(output):
+    multi = output.startswith('..')
+    if multi:
+        output = output[2:-2]
+    outputs = [tuple(part.rsplit('.', 1)) for part in output.split('...')]
+
+    return outputs, multi
+
+class DashClient:
+    def __init__(self, base_url, dependencies, layout_values, layout_types, poll_timeout=120):
+        self.base_url = base_url
+        self.values = dict(layout_values)
+        self.intervals = [component_id for component_id, component_type in layout_types.items() if component_type == 'Interval']
+        self.poll_timeout = poll_timeout
+        self.callbacks = {}
+        for dependency in dependencies:
+            if dependency.get('clientside_function'):
+                continue
+            outputs, multi = parse_outputs(dependency['output'])
+            callback = {
+                'output': dependency['output'],
+                'outputs': outputs,
+                'multi': multi,
+                'inputs': [(item['id'], item['property']) for item in dependency['inputs']],
+                'state': [(item['id'], item['property']) for item in dependency['state']],
+            }
+            for trigger in callback['inputs']:
+                self.callbacks.setdefault(trigger, []).append(callback)
+
+    # Build the _dash-update-component body for one callback
+    def payload(self, callback, changed):
+        outputs = [{'id': component_id, 'property': prop} for component_id, prop in callback['outputs']]
+
+        return {
+            'output': callback['output'],
+            'outputs': outputs if callback['multi'] else outputs[0],
+            'inputs': [{'id': component_id, 'property': prop, 'value': self.values.get((component_id, prop))}
+                       for component_id, prop in callback['inputs']],
+            'state': [{'id': component_id, 'property': prop, 'value': self.values.get((component_id, prop))}
+                      for component_id, prop in callback['state']],
+            'changedPropIds': ['{}.{}'.format(*prop_id) for prop_id in changed],
+        }
+
+    # POST one callback, store its outputs and return the properties it changed
+    def call(self, callback, changed, results):
+        body = json.dumps(self.payload(callback, changed)).encode('utf-8')
+        request = urllib.request.Request(
+            self.base_url + '/_dash-update-component',
+            data=body,
+            headers={'Content-Type': 'application/json'}
+        )
+
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request, timeout=120) as response:
+                status = response.status
+                content = response.read()
+            error = None
+        except urllib.error.HTTPError as e:
+            status = e.code
+            content = b''
+            error = 'HTTP {}'.format(e.code)
+        except Exception as e:
+            status = None
+            content = b''
+            error = type(e).__name__
+        results.append((callback['output'], time.perf_counter() - start, error))
+
+        # 204 means the callback raised PreventUpdate
+        if status != 200 or not content:
+            return []
+        updated = []
+        for output_id, output_props in json.loads(content).get('response', {}).items():
+            for output_prop, output_value in output_props.items():
+                self.values[(output_id, output_prop)] = output_value
+                updated.append((output_id, output_prop))
+
+        return updated
+
+    # Run the callbacks triggered by changed properties, following chains through their outputs
+    def propagate(self, pending, results):
+        while pending:
+            changed = pending.pop(0)
+            for callback in self.callbacks.get(changed, []):
+                pending += self.call(callback, [changed], results)
+
+    # Tick every enabled interval until all are disabled, recording the wait as '<interval id> (polling)'
+    def poll(self, start, results):
+        while True:
+            enabled = [component_id for component_id in self.intervals if not self.values.get((component_id, 'disabled'), False)]
+            if not enabled:
+                return
+            if time.perf_counter() - start > self.poll_timeout:
+                for component_id in enabled:
+                    results.append(('{} (polling)'.format(component_id), time.perf_counter() - start, 'poll timeout'))
+                    self.values[(component_id, 'disabled')] = True
+                return
+
+            time.sleep(min(self.values.get((component_id, 'interval'), 1000) for component_id in enabled) / 1000)
+            for component_id in enabled:
+                self.values[(component_id, 'n_intervals')] = (self.values.get((component_id, 'n_intervals')) or 0) + 1
+                self.propagate([(component_id, 'n_intervals')], results)
+                if self.values.get((component_id, 'disabled'), False):
+                    results.append(('{} (polling)'.format(component_id), time.perf_counter() - start, None))
+
+    # Run every callback once, as the browser does when the page loads
+    def load(self, results):
+        start = time.perf_counter()
+        initial = []
+        for callback in {id(callback): callback for callbacks in self.callbacks.values() for callback in callbacks}.values():
+            initial += self.call(callback, [], results)
+        self.propagate(initial, results)
+        self.poll(start, results)
+
+    # Set a property and run every callback it triggers, recording (callback, seconds, error) per request.
+    # Intermediate slider drag steps do not wait for background renders, like a user still dragging
+    def change(self, component_id, prop, value, results, wait=True):
+        start = time.perf_counter()
+        self.values[(component_id, prop)] = value
+        self.propagate([(component_id, prop)], results)
+        if wait:
+            self.poll(start, results)
+
+
+### Server control
+
+# Fetch a JSON endpoint from the server
+def get_json(base_url, path):
+    with urllib.request.urlopen(base_url + path, timeout=30) as response:
+        return json.loads(response.read())
+
+# Start gunicorn and wait until the Dash layout is served
+def start_server(workers, threads, port, startup_timeout):
+    command = [
+        sys.executable, '-m', 'gunicorn', 'app:server',
+        '--bind', '127.0.0.1:{}'.format(port),
+        '--workers', str(workers),
+        '--threads', str(threads),
+        '--timeout', '300',
+    ]
+    server = subprocess.Popen(command, cwd=REPO_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base_url = 'http://127.0.0.1:{}'.format(port)
+
+    deadline = time.time() + startup_timeout
+    while time.time() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError('gunicorn exited with code {}'.format(server.returncode))
+        try:
+            get_json(base_url, '/_dash-layout')
+            return server, base_url
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.5)
+
+    server.terminate()
+    raise RuntimeError('gunicorn did not start within {} seconds'.format(startup_timeout))
+
+def stop_server(server):
+    server.terminate()
+    try:
+        server.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        server.kill()
+
+
+### Load run
+
+# Replay sessions from concurrent users until the duration is over
+def run_load(base_url, sessions, n_users, duration):
+    layout_values = {}
+    layout_types = {}
+    collect_props(get_json(base_url, '/_dash-layout'), layout_values, layout_types)
+    dependencies = get_json(base_url, '/_dash-dependencies')
+
+    results = []
+    results_lock = threading.Lock()
+    stop_time = time.time() + duration
+
+    def user(user_index):
+        session = sessions[user_index % len(sessions)]
+        client = DashClient(base_url, dependencies, layout_values, layout_types)
+        user_results = []
+        client.load(user_results)
+        while time.time() < stop_time:
+            for step in session:
+                if time.time() >= stop_time:
+                    break
+                start = time.perf_counter()
+                client.change(step['id'], step['property'], step['value'], user_results, step.get('wait', True))
+                if step['id'] == 'municipality':
+                    user_results.append(('municipality switch (total)', time.perf_counter() - start, None))
+                time.sleep(step.get('pause', 0))
+        with results_lock:
+            results.extend(user_results)
+
+    start = time.time()
+    users = [threading.Thread(target=user, args=(i,)) for i in range(n_users)]
+    for thread in users:
+        thread.start()
+    for thread in users:
+        thread.join()
+
+    return results, time.time() - start
+
+# Query /_worker-memory until every worker has answered (or the attempts run out), returning one report per pid
+def sample_worker_memory(base_url, n_workers, attempts_per_worker=10):
+    reports = {}
+    for _ in range(n_workers * attempts_per_worker):
+        try:
+            memory = get_json(base_url, '/_worker-memory')
+        except (urllib.error.URLError, ConnectionError, ValueError):
+            break
+        reports[memory['pid']] = memory
+        if len(reports) >= n_workers:
+            break
+
+    return [reports[pid] for pid in sorted(reports)]
+
+# Nearest-rank percentile of a sorted list
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return float('nan')
+    index = max(0, int(round(q / 100 * len(sorted_values))) - 1)
+
+    return sorted_values[min(index, len(sorted_values) - 1)]
+
+# Summarize latencies, throughput and errors for a group of requests
+def summarize(results, elapsed):
+    latencies = sorted(seconds * 1000 for _, seconds, error in results if error is None)
+    n_errors = sum(1 for _, _, error in results if error is not None)
+
+    return {
+        'requests': len(results),
+        'errors': n_errors,
+        'throughput': len(results) / elapsed if elapsed > 0 else 0,
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+    }
+
+def print_report(workers, threads, results, elapsed, worker_memory=None):
+    header = '{:<60} {:>9} {:>7} {:>9} {:>9} {:>9} {:>9}'
+    row = '{:<60} {:>9} {:>7} {:>9.1f} {:>9.0f} {:>9.0f} {:>9.0f}'
+
+    print()
+    print('workers={} threads={} elapsed={:.1f}s'.format(workers, threads, elapsed))
+    print(header.format('callback', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for output in sorted(set(output for output, _, _ in results)):
+        stats = summarize([result for result in results if result[0] == output], elapsed)
+        print(row.format(output[:60], stats['requests'], stats['errors'], stats['throughput'], stats['p50'], stats['p95'], stats['p99']))
+    stats = summarize(results, elapsed)
+    print(row.format('all', stats['requests'], stats['errors'], stats['throughput'], stats['p50'], stats['p95'], stats['p99']))
+
+    if worker_memory:
+        print('{:>8} {:>10} {:>10} {:>10} {:>10}'.format('pid', 'RSS MB', 'PSS MB', 'shared MB', 'private MB'))
+        for memory in worker_memory:
+            print('{:>8} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f}'.format(
+                memory['pid'],
+                memory.get('VmRSS', float('nan')),
+                memory.get('Pss', float('nan')),
+                memory.get('Shared_Clean', 0) + memory.get('Shared_Dirty', 0),
+                memory.get('Private_Clean', 0) + memory.get('Private_Dirty', 0)
+            ))
+
+    errors = {}
+    for _, _, error in results:
+        if error is not None:
+            errors[error] = errors.get(error, 0) + 1
+    for error, count in sorted(errors.items()):
+        print('  {}: {}'.format(error, count))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay dashboard interactions against local gunicorn servers.')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4], help='gunicorn worker counts to test')
+    parser.add_argument('--threads', type=int, nargs='+', default=[1], help='gunicorn thread counts per worker to test')
+    parser.add_argument('--users', type=int, default=8, help='number of concurrent user sessions')
+    parser.add_argument('--duration', type=float, default=60, help='seconds to run each configuration')
+    parser.add_argument('--actions', type=int, default=20, help='actions per generated session')
+    parser.add_argument('--municipalities', type=int, default=12, help='number of municipalities generated sessions switch between, by crash count')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for generated sessions')
+    parser.add_argument('--sessions', help='JSON file of recorded sessions to replay instead of generated ones')
+    parser.add_argument('--save-sessions', help='write the sessions used to this JSON file')
+    parser.add_argument('--port', type=int, default=8051)
+    parser.add_argument('--startup-timeout', type=float, default=180)
+    parser.add_argument('--url', help='run against an already running server instead of starting gunicorn')
+    args = parser.parse_args()
+
+    if args.sessions:
+        with open(args.sessions) as f:
+            sessions = json.load(f)
+    else:
+        rng = random.Random(args.seed)
+        municipalities = read_municipalities(args.municipalities)
+        sessions = [generate_session(rng, args.actions, municipalities) for _ in range(args.users)]
+    if args.save_sessions:
+        with open(args.save_sessions, 'w') as f:
+            json.dump(sessions, f, indent=1)
+
+    if args.url:
+        results, elapsed = run_load(args.url.rstrip('/'), sessions, args.users, args.duration)
+        print_report('?', '?', results, elapsed, sample_worker_memory(args.url.rstrip('/'), 1))
+        return
+
+    for workers in args.workers:
+        for threads in args.threads:
+            server, base_url = start_server(workers, threads, args.port, args.startup_timeout)
+            try:
+                results, elapsed = run_load(base_url, sessions, args.users, args.duration)
+                worker_memory = sample_worker_memory(base_url, workers)
+            finally:
+                stop_server(server)
+            print_report(workers, threads, results, elapsed, worker_memory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,259 @@
+import numpy as np
+import pandas as pd
+
+### Recode specification shared by data-preprocessing.py and app.py
+#
+# Each column may declare:
+#   fill      - value imputed for missing entries
+#   fill_from - column whose value is imputed for missing entries
+#   remap     - text values merged before encoding
+#   encode    - ordered categories of a text column, encoded as their position
+#   fallback  - category of an encoded column that unexpected text values are encoded as. Without one,
+#               an unexpected value stops preprocessing rather than dropping or guessing for the crash
+#   group     - codes merged after the k-modes clustering, so the dashboard shows them as one category
+#   derive    - binary flag columns combined into an ordinal, the highest flag set wins
+#   labels    - dashboard labels of the final codes, any other code is reported as unmapped
+#   flag      - dashboard label of a binary flag column, any code other than 0 and 1 is reported as unmapped
+
+RECODE_SPEC = {
+    'ILLUMINATION': {
+        'labels': {
+            1: 'Daylight',
+            2: 'Dark - No Street Lights',
+            3: 'Dark - Street Lights',
+            4: 'Dusk',
+            5: 'Dawn',
+            6: 'Dark - Unknown Roadway Lighting',
+            8: 'Other or Unknown'
+        }
+    },
+    'COLLISION_TYPE': {
+        'group': {98: 9, 99: 9},
+        'labels': {
+            0: 'Non-Collision',
+            1: 'Rear-End',
+            2: 'Head-On',
+            3: 'Rear-to-Rear (Backing)',
+            4: 'Angle',
+            5: 'Sideswipe (Same Direction)',
+            6: 'Sideswipe (Opposite Direction)',
+            7: 'Hit Fixed Object',
+            8: 'Hit Pedestrian',
+            9: 'Other or Unknown'
+        }
+    },
+    'ROAD_CONDITION': {
+        'fill': 1,
+        'group': {8: 9, 22: 9, 98: 9, 99: 9},
+        'labels': {
+            0: 'Dry',
+            1: 'Wet',
+            2: 'Sand / Mud / Dirt / Oil / Gravel',
+            3: 'Snow-Covered',
+            4: 'Slush',
+            5: 'Ice',
+            6: 'Ice Patches',
+            7: 'Water (Standing or Moving)',
+            9: 'Other or Unknown'
+        }
+    },
+    'RELATION_TO_ROAD': {
+        'labels': {
+            1: 'On Roadway',
+            2: 'Shoulder',
+            3: 'Median',
+            4: 'Roadside ',
+            5: 'Outside Trafficway ',
+            6: 'In Parking Lane',
+            7: 'Intersection of Ramp and Highway',
+            9: 'Other or Unknown'
+        }
+    },
+    'MAX_INJURY_SEVERITY': {
+        'derive': ['MINOR_INJURY', 'MODERATE_INJURY', 'MAJOR_INJURY', 'FATAL'],
+        'labels': {
+            0: 'No Injuries Reported',
+            1: 'Minor Injury',
+            2: 'Moderate Injury',
+            3: 'Major Injury',
+            4: 'Fatal ',
+        }
+    },
+    'DAY_OF_WEEK': {
+        'labels': {
+            1: 'Sunday',
+            2: 'Monday',
+            3: 'Tuesday',
+            4: 'Wednesday',
+            5: 'Thursday',
+            6: 'Friday',
+            7: 'Saturday'
+        }
+    },
+    'HOUR_OF_DAY': {
+        'fill': 99,
+        'labels': dict([(hour, '{}:00'.format(hour)) for hour in range(24)] + [(99, 'Unknown')])
+    },
+
+    # Binary flags, in the order the dashboard lists them
+    'INTERSTATE': {'flag': 'Interstate'},
+    'STATE_ROAD': {'flag': 'State Road'},
+    'LOCAL_ROAD': {'fill_from': 'LOCAL_ROAD_ONLY', 'flag': 'Local Road'},
+    'WORK_ZONE_IND': {'encode': ['N', 'Y'], 'fallback': 'N', 'flag': 'Work Zone'},
+    'SCH_ZONE_IND': {'fill': 'N', 'encode': ['N', 'Y'], 'fallback': 'N', 'flag': 'School Zone'},
+    'BICYCLE': {'flag': 'Bicycle'},
+    'PEDESTRIAN': {'flag': 'Pedestrian'},
+    'MOTORCYCLE': {'flag': 'Motorcycle'},
+    'HAZARDOUS_TRUCK': {'flag': 'Hazardous Truck'},
+    'HVY_TRUCK_RELATED': {'flag': 'Heavy Truck'},
+    'DEER_RELATED': {'flag': 'Deer'},
+    'UNBELTED': {'flag': 'Unbelted Passengers/Driver'},
+    'UNLICENSED': {'flag': 'Unlicensed Driver'},
+    'ALCOHOL_RELATED': {'flag': 'Alcohol Related'},
+    'DRUG_RELATED': {'flag': 'Drug Related'},
+    'CELL_PHONE': {'flag': 'Cell Phone'},
+    'IMPAIRED_DRIVER': {'flag': 'Impaired Driver'},
+    'DISTRACTED': {'flag': 'Distracted Driver'},
+    'FATIGUE_ASLEEP': {'flag': 'Fatigue / Asleep'},
+    'TAILGATING': {'flag': 'Tailgating'},
+    'SPEEDING_RELATED': {'flag': 'Speeding'},
+    'AGGRESSIVE_DRIVING': {'flag': 'Aggressive Driving'},
+    'RUNNING_RED_LT': {'flag': 'Running a Red Light'},
+    'CURVED_ROAD': {'flag': 'Curved Road'},
+
+    # Columns only cleaned for the k-modes clustering
+    'WEATHER': {'fill': 1},
+    'MODERATE_INJURY': {'fill': 0},
+    'SCH_BUS_IND': {'fill': 'N', 'encode': ['N', 'Y'], 'fallback': 'N'},
+    'NTFY_HIWY_MAINT': {'fill': 'N', 'encode': ['N', 'Y'], 'fallback': 'N'},
+    'TFC_DETOUR_IND': {'fill': 'N', 'encode': ['N', 'U', 'Y'], 'fallback': 'U'},
+    'RDWY_ORIENT': {'fill': 'U', 'remap': {'B': 'U'}, 'encode': ['E', 'N', 'S', 'U', 'W'], 'fallback': 'U'},
+}
+
+# Severity weights indexed by MAX_INJURY_SEVERITY (none, minor, moderate, major, fatal)
+SEVERITY_WEIGHTS = np.array([1, 3, 5, 10, 20])
+
+# Codes are at most two digits, so code lookups are dense arrays indexed by the code
+LOOKUP_SIZE = 100
+
+
+### Label dictionaries used by the dashboard
+
+def label_dict(column):
+    return dict(RECODE_SPEC[column]['labels'])
+
+FLAG_LABELS = {column: spec['flag'] for column, spec in RECODE_SPEC.items() if 'flag' in spec}
+
+# Categorical columns with dashboard labels, e.g. the features of the cluster profile besides the flags
+LABELLED_COLUMNS = [column for column, spec in RECODE_SPEC.items() if 'labels' in spec]
+
+ENCODED_COLUMNS = [column for column, spec in RECODE_SPEC.items() if 'encode' in spec]
+
+
+### Compile the specification into per-column lookup arrays
+
+def compile_column(spec):
+    compiled = {key: spec[key] for key in ('fill', 'fill_from', 'derive') if key in spec}
+
+    # Text lookup: sorted source values and the position of their (remapped) category
+    if 'encode' in spec:
+        remap = spec.get('remap', {})
+        keys = sorted(set(spec['encode']) | set(remap))
+        compiled['encode_keys'] = np.array(keys)
+        compiled['encode_codes'] = np.array([spec['encode'].index(remap.get(key, key)) for key in keys], dtype=float)
+        compiled['encode_fallback'] = spec['encode'].index(spec['fallback']) if 'fallback' in spec else None
+
+    # Code lookup: every code maps to itself unless it is grouped into another code
+    if 'group' in spec:
+        group_lookup = np.arange(LOOKUP_SIZE, dtype=float)
+        group_lookup[list(spec['group'])] = list(spec['group'].values())
+        compiled['group_lookup'] = group_lookup
+
+    # Codes the dashboard can label
+    if 'labels' in spec or 'flag' in spec:
+        known = np.zeros(LOOKUP_SIZE, dtype=bool)
+        known[list(spec['labels']) if 'labels' in spec else [0, 1]] = True
+        compiled['known'] = known
+
+    return compiled
+
+COMPILED_SPEC = {column: compile_column(spec) for column, spec in RECODE_SPEC.items()}
+
+
+### Apply the compiled specification, one vectorized pass per column
+
+# Split codes into those that can index a lookup array and those that cannot
+def valid_codes(values):
+    codes = np.asarray(values, dtype=float)
+    valid = np.isfinite(codes) & (codes >= 0) & (codes < LOOKUP_SIZE) & (codes == np.floor(codes))
+    return codes, valid
+
+# Encode text values through the sorted keys, sending unexpected values to the fallback code.
+# Missing values stay missing
+def lookup_categories(values, keys, codes, fallback):
+    missing = pd.isna(values)
+    text = np.where(missing, '', values).astype(str)
+    index = np.minimum(np.searchsorted(keys, text), len(keys) - 1)
+    matched = (keys[index] == text) & ~missing
+    fallback = np.nan if fallback is None else fallback
+    return np.where(matched, codes[index], np.where(missing, np.nan, fallback)), ~matched & ~missing
+
+# Impute missing values and encode text columns ahead of dropna and the k-modes clustering
+def apply_clean(df):
+    report = []
+    for column, compiled in COMPILED_SPEC.items():
+        if column not in df.columns or not {'fill', 'fill_from', 'encode_keys'} & set(compiled):
+            continue
+
+        values = df[column].values
+        missing = pd.isna(values)
+        if 'fill' in compiled:
+            values = np.where(missing, compiled['fill'], values)
+        elif 'fill_from' in compiled:
+            values = np.where(missing, df[compiled['fill_from']].values, values)
+        imputed = missing & ~pd.isna(values)
+
+        unmapped = np.zeros(len(df), dtype=bool)
+        remapped = np.zeros(len(df), dtype=bool)
+        if 'encode_keys' in compiled:
+            if 'remap' in RECODE_SPEC[column]:
+                remapped = np.isin(values, list(RECODE_SPEC[column]['remap']))
+            encoded, unmapped = lookup_categories(values, compiled['encode_keys'], compiled['encode_codes'], compiled['encode_fallback'])
+            if unmapped.any() and compiled['encode_fallback'] is None:
+                raise ValueError('{} has values {} outside its encoding and no fallback'.format(column, np.unique(values[unmapped].astype(str)).tolist()))
+            values = encoded
+
+        df[column] = values
+        report.append({'COLUMN': column, 'STAGE': 'clean', 'IMPUTED': imputed.sum(),
+                       'REMAPPED': remapped.sum(), 'UNMAPPED': unmapped.sum()})
+
+    return df, report
+
+# Group and derive the codes the dashboard shows, and count codes it has no label for
+def apply_recode(df):
+    report = []
+    for column, compiled in COMPILED_SPEC.items():
+        if 'derive' in compiled:
+            flags = df[compiled['derive']].values == 1
+            df[column] = (flags * np.arange(1, flags.shape[1] + 1)).max(axis=1)
+        if column not in df.columns or not {'group_lookup', 'known'} & set(compiled):
+            continue
+
+        codes, valid = valid_codes(df[column].values)
+        remapped = np.zeros(len(df), dtype=bool)
+        if 'group_lookup' in compiled:
+            grouped = codes.copy()
+            grouped[valid] = compiled['group_lookup'][codes[valid].astype(int)]
+            remapped = valid & (grouped != codes)
+            df[column] = grouped.astype(df[column].dtype)
+            codes = grouped
+
+        unmapped = np.zeros(len(df), dtype=bool)
+        if 'known' in compiled:
+            unmapped = ~valid
+            unmapped[valid] = ~compiled['known'][codes[valid].astype(int)]
+
+        report.append({'COLUMN': column, 'STAGE': 'recode', 'IMPUTED': 0,
+                       'REMAPPED': remapped.sum(), 'UNMAPPED': unmapped.sum()})
+
+    return df, report